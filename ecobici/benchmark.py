@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import add_features, aggregate_trips, aggregate_trips_chunked, add_weather_features, load_trips, load_weather_holidays, preprocess_data
+from utils.preprocessor import AddQuadrantColumn, DatetimeTransformer, DateFeaturesTransformer, TimeFeaturesTransformer, AverageTempLast7DaysTransformer, RatioTempTransformer, RollingAveragesTransformer, MergeHolidaysTransformer, ReplaceOutliersByDayOfWeek
+from utils.synthetic import generate_trips, make_stations, parse_size, write_trips
+
+RESULTS_PATH = 'benchmark_results.jsonl'
+STAGE_GROUPS = ['transformers', 'preprocess', 'fit', 'chunked']
+# The synthetic trips take about 1 GB per million rows in memory, and the in memory stages copy them. Larger sizes are
+# written to a file in chunks and only the chunked preprocessing is measured on them
+MAX_IN_MEMORY_ROWS = '1M'
+
+
+def measure(stage, n_rows, func, make_input, repeat=1):
+    """Time func on a fresh input (best of repeat runs), then run it once more tracing the memory it allocates.
+    Building the input is not measured."""
+
+    seconds = []
+    for _ in range(repeat):
+        X = make_input()
+        start = time.perf_counter()
+        output = func(X)
+        seconds.append(time.perf_counter() - start)
+        del X, output
+
+    X = make_input()
+    tracemalloc.start()
+    output = func(X)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del X, output
+
+    result = {'stage': stage, 'rows': n_rows, 'seconds': min(seconds), 'peak_memory_mb': peak / 1024**2}
+    print(f"{stage:<35} {n_rows:>10} rows {result['seconds']:>9.3f} s {result['peak_memory_mb']:>9.1f} MB")
+    return result
+
+
+def synthetic_trips(n_rows, chunksize=1_000_000, seed=0):
+    """Synthetic trips in memory, generated in chunks like utils/synthetic.py writes them.
+    The whole table is kept in memory (about 1 GB per million rows), larger sizes go through benchmark_chunked."""
+
+    stations = make_stations(seed=seed)
+    chunks = [
+        generate_trips(min(chunksize, n_rows - first_row), stations, seed=seed + i + 1, first_id=first_row)
+        for i, first_row in enumerate(range(0, n_rows, chunksize))
+    ]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def benchmark_transformers(trips, weather, ar_holidays, repeat=1):
+    """Measure each transformer on the output of the steps before it"""
+
+    n_rows = len(trips)
+    results = []
+
+    def run(transformer):
+        return lambda X: transformer.fit(X).transform(X)
+
+    # trip level transformers
+    trips_quadrant = AddQuadrantColumn().fit_transform(trips.copy())
+    trips_datetime = DatetimeTransformer().transform(trips_quadrant.copy())
+    results.append(measure('AddQuadrantColumn', n_rows, run(AddQuadrantColumn()), trips.copy, repeat))
+    results.append(measure('DatetimeTransformer', n_rows, run(DatetimeTransformer()), trips_quadrant.copy, repeat))
+    results.append(measure('DateFeaturesTransformer', n_rows, run(DateFeaturesTransformer()), trips_datetime.copy, repeat))
+    results.append(measure('TimeFeaturesTransformer', n_rows, run(TimeFeaturesTransformer()), trips_datetime.copy, repeat))
+    del trips_quadrant, trips_datetime
+
+    # weather transformers, they run on the weather table and are labelled with its rows
+    weather_avg = AverageTempLast7DaysTransformer().fit_transform(weather.copy())
+    results.append(measure('AverageTempLast7DaysTransformer', len(weather), run(AverageTempLast7DaysTransformer()), weather.copy, repeat))
+    results.append(measure('RatioTempTransformer', len(weather_avg), run(RatioTempTransformer()), weather_avg.copy, repeat))
+
+    # transformers on the trips by date and quadrant, labelled with the rows of that table
+    trips_dt_wht = add_weather_features(aggregate_trips(trips.copy()), weather.copy())
+    trips_rolling = RollingAveragesTransformer().fit_transform(trips_dt_wht.copy())
+    trips_holidays = MergeHolidaysTransformer(holidays_df=ar_holidays).fit_transform(trips_rolling.copy())
+    n_aggregated = len(trips_dt_wht)
+    results.append(measure('RollingAveragesTransformer', n_aggregated, run(RollingAveragesTransformer()), trips_dt_wht.copy, repeat))
+    results.append(measure('MergeHolidaysTransformer', n_aggregated, run(MergeHolidaysTransformer(holidays_df=ar_holidays)), trips_rolling.copy, repeat))
+    results.append(measure('ReplaceOutliersByDayOfWeek', n_aggregated, run(ReplaceOutliersByDayOfWeek()), trips_holidays.copy, repeat))
+    return results
+
+
+def benchmark_chunked(n_rows, weather, ar_holidays, chunksize=1_000_000, repeat=1):
+    """Write n_rows synthetic trips to a temporary file in chunks and measure the chunked preprocessing on it
+    (aggregate_trips_chunked and add_features). Memory depends on chunksize, so it runs for sizes that do not fit in memory"""
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'trips.csv')
+    try:
+        write_trips(path, n_rows, chunksize=chunksize)
+
+        def preprocess(path):
+            return add_features(aggregate_trips_chunked(path, chunksize=chunksize), weather.copy(), ar_holidays)
+
+        return [measure('preprocess_chunked', n_rows, preprocess, lambda: path, repeat)]
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_fit(trips_preprocessed, n_rows, repeat=1):
+    """Measure the training of the XGBoost pipeline and of the auto-arima models on the preprocessed trips"""
+
+    from fit import FIT_COLUMNS, fit_xgboost_model, generate_arima_sets, generate_train_test_xgboost, select_train_test_indexes, train_autoarima
+
+    trips_preprocessed = trips_preprocessed[FIT_COLUMNS].reset_index(drop=True)
+    idx_train, idx_test = select_train_test_indexes(trips_preprocessed)
+    X_train, y_train, X_test, y_test = generate_train_test_xgboost(trips_preprocessed, idx_train, idx_test)
+    ts_train, ts_test = generate_arima_sets(trips_preprocessed, idx_train, idx_test)
+
+    return [
+        measure('fit_xgboost_model', n_rows, lambda X: fit_xgboost_model(X, y_train), X_train.copy, repeat),
+        measure('train_autoarima', n_rows, train_autoarima, ts_train.copy, repeat),
+    ]
+
+
+def run_metadata():
+    """Identify the run: commit, library versions and machine"""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'run_id': uuid.uuid4().hex[:12],
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+    }
+
+
+def write_results(results, metadata, path=RESULTS_PATH):
+    """Append one JSON line per result, with the metadata of the run"""
+
+    with open(path, 'a') as file:
+        for result in results:
+            file.write(json.dumps({**metadata, **result}) + '\n')
+    print(f'results saved in {path}')
+
+
+def compare_with_previous(results, run_id, path=RESULTS_PATH):
+    """Compare the time and memory of each stage with the previous run that measured it"""
+
+    history = pd.read_json(path, lines=True)
+    previous = history[history['run_id'] != run_id].groupby(['stage', 'rows']).last()
+    current = pd.DataFrame(results).set_index(['stage', 'rows'])
+
+    comparison = current[['seconds', 'peak_memory_mb']].join(previous[['seconds', 'peak_memory_mb', 'commit']], rsuffix='_previous', how='inner')
+    if comparison.empty:
+        print('no previous results to compare with')
+        return comparison
+    comparison['time_ratio'] = comparison['seconds'] / comparison['seconds_previous']
+    comparison['memory_ratio'] = comparison['peak_memory_mb'] / comparison['peak_memory_mb_previous']
+    print(comparison.round(3).to_string())
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing and training stages on synthetic trips')
+    parser.add_argument('--sizes', default='100k,1M', help='comma separated row counts, among 100k, 1M, 10M, 50M or numbers')
+    parser.add_argument('--trips', default=None, help='benchmark this trips file instead of synthetic trips')
+    parser.add_argument('--stages', default=','.join(STAGE_GROUPS), help=f'comma separated groups among {", ".join(STAGE_GROUPS)}')
+    parser.add_argument('--max-in-memory', default=MAX_IN_MEMORY_ROWS,
+                        help='largest synthetic size built in memory, larger sizes only run the chunked stage')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs of each stage, the best one is kept')
+    parser.add_argument('--output', default=RESULTS_PATH, help='JSON lines file the results are appended to')
+    parser.add_argument('--compare', action='store_true', help='compare with the previous run saved in the output file')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    weather, ar_holidays = load_weather_holidays()
+    metadata = run_metadata()
+
+    results = []
+    for size in ([None] if args.trips else args.sizes.split(',')):
+        if size is not None and 'chunked' in stages:
+            results += benchmark_chunked(parse_size(size), weather, ar_holidays, repeat=args.repeat)
+        if size is not None and parse_size(size) > parse_size(args.max_in_memory):
+            print(f'{size} trips are above --max-in-memory {args.max_in_memory}, only the chunked stage is measured')
+            continue
+        if not set(stages) & {'transformers', 'preprocess', 'fit'}:
+            continue
+
+        trips = load_trips(args.trips) if args.trips else synthetic_trips(parse_size(size))
+        n_rows = len(trips)
+        print(f'benchmarking {n_rows} trips')
+
+        if 'transformers' in stages:
+            results += benchmark_transformers(trips, weather, ar_holidays, repeat=args.repeat)
+
+        if 'preprocess' in stages or 'fit' in stages:
+            results.append(measure('preprocess_data', n_rows, lambda X: preprocess_data(X, weather.copy(), ar_holidays), trips.copy, args.repeat))
+
+        if 'fit' in stages:
+            trips_preprocessed = preprocess_data(trips.copy(), weather.copy(), ar_holidays)
+            results += benchmark_fit(trips_preprocessed, n_rows, repeat=args.repeat)
+        del trips
+
+    had_results = os.path.exists(args.output)
+    write_results(results, metadata, args.output)
+    if args.compare and had_results:
+        compare_with_previous(results, metadata['run_id'], args.output)
+
+if __name__ == "__main__":
+    main()
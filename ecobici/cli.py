@@ -0,0 +1,88 @@
+import time
+
+# process start, to report the cold start of the predict command
+START = time.perf_counter()
+
+import argparse
+
+
+def preprocess(argv):
+    import preprocessing
+
+    preprocessing.main(argv)
+
+
+def train_xgb(argv):
+    import fit
+
+    fit.main(argv, steps=('train-xgb',))
+
+
+def train_arima(argv):
+    import fit
+
+    fit.main(argv, steps=('train-arima',))
+
+
+def tune(argv):
+    import fit
+
+    fit.main(argv, steps=('tune',))
+
+
+def predict(argv):
+    """Predict trips for every row of a preprocessed dataset with a saved XGBoost artifact"""
+    parser = argparse.ArgumentParser(prog='cli.py predict', description=predict.__doc__)
+    parser.add_argument('--model', default='models/xgboost_model', help='artifact directory saved by train-xgb or tune')
+    parser.add_argument('--data', default='trips_preprocessed',
+                        help='preprocessed dataset, a CSV file or a Parquet dataset directory')
+    parser.add_argument('--output', default='predictions.csv')
+    args = parser.parse_args(argv)
+
+    import os
+    import pandas as pd
+    import xgboost  # noqa: F401, imported here so its import time is not counted as model load
+    from utils.artifacts import load_xgboost_artifact
+
+    imported = time.perf_counter()
+    model = load_xgboost_artifact(args.model)
+    loaded = time.perf_counter()
+
+    columns = ['date_formatted'] + [column for step in model.manifest['steps'] for column in step['columns']]
+    if os.path.isdir(args.data):
+        from utils.storage import read_dataset
+
+        trips_preprocessed = read_dataset(args.data, columns=columns)
+    else:
+        trips_preprocessed = pd.read_csv(args.data, usecols=columns)
+
+    start_predict = time.perf_counter()
+    trips_preprocessed['prediction'] = model.predict(trips_preprocessed)
+    predicted = time.perf_counter()
+
+    # models trained on the hourly dataset also predict by hour
+    keys = ['date_formatted', 'hour', 'quadrant'] if 'hour' in trips_preprocessed.columns else ['date_formatted', 'quadrant']
+    trips_preprocessed[keys + ['prediction']].to_csv(args.output, index=False)
+    print(f'saved {len(trips_preprocessed)} predictions in {args.output}')
+    print(f'cold start: {loaded - START:.3f}s (imports {imported - START:.3f}s, model load {loaded - imported:.3f}s)')
+    print(f'predict: {predicted - start_predict:.3f}s')
+
+
+COMMANDS = {
+    'preprocess': preprocess,
+    'train-xgb': train_xgb,
+    'train-arima': train_arima,
+    'tune': tune,
+    'predict': predict,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ecobici demand forecasting. Run a command with --help to see its options.')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('options', nargs=argparse.REMAINDER, help='options of the command')
+    args = parser.parse_args()
+    COMMANDS[args.command](args.options)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,69 @@
 import pandas as pd
 import numpy as np
-import xgboost as xgb
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.impute import SimpleImputer
-from sklearn.metrics import mean_squared_error, mean_absolute_percentage_error
-from sklearn.model_selection import RandomizedSearchCV
-from pmdarima import auto_arima
+from sklearn.model_selection import RandomizedSearchCV, TimeSeriesSplit
+import argparse
 import os
 import pickle
-
-def load_data():
-    """Load preprocessed trip data"""
-
-    trips_preprocessed = pd.read_csv('trips_preprocessed')
+import tempfile
+from contextlib import nullcontext
+
+# xgboost, pmdarima, pyarrow and the halving search are imported in the functions that use them,
+# so each command only pays for the libraries of the models it runs
+
+from utils.artifacts import save_xgboost_artifact
+from utils.evaluator import compute_metrics, prediction_table
+from utils.instrumentation import StageTracer, instrument, trace
+
+# Features used by the XGBoost model
+WEATHER_VARS = ['weather_code (wmo code)', 'temperature_2m_mean (°C)', 'temperature_2m_max (°C)', 'precipitation_sum (mm)', 'precipitation_hours (h)', 'wind_speed_10m_max (km/h)','ratio_temp_max_to_avg_last_7_days']
+HISTORY_VARS = ['avg_trips_last_week', 'avg_trips_last_month', 'trips_same_day_last_week']
+FLAGS = ['is_weekend','is_holiday']
+CATEGORICAL_VARS = ['quadrant']
+
+# Features of the XGBoost model for trips by hour, instead of the daily history. The hourly weather is used when the
+# dataset was preprocessed with an hourly weather file
+HOURLY_HISTORY_VARS = ['avg_trips_last_day', 'trips_same_hour_yesterday', 'trips_same_hour_last_week', 'avg_trips_same_hour_last_week']
+HOURLY_WEATHER_VARS = ['temperature_2m (°C)', 'precipitation (mm)']
+HOUR_VARS = ['hour']
+
+# Exogenous features used by the auto-arima models
+ARIMA_FEATURES = ['is_weekend','is_holiday','precipitation_hours (h)', 'temperature_2m_mean (°C)']
+
+# Hiperparameters explored when fine tuning the XGBoost model
+PARAM_DIST = {
+    'xgb__n_estimators': [50, 100, 150],
+    'xgb__learning_rate': [0.01, 0.1, 0.2],
+    'xgb__max_depth': [3, 5, 7],
+    'xgb__min_child_weight': [1, 3, 5, 8, 10, 13, 15],
+    'xgb__subsample': [0.8, 1.0],
+    'xgb__colsample_bytree': [0.8, 1.0],
+    'xgb__gamma': [0, 1, 2],
+    'xgb__reg_alpha': [0, 0.1, 0.5],
+    'xgb__reg_lambda': [0.1, 1, 2],
+}
+
+# Columns needed to train and evaluate both models
+FIT_COLUMNS = list(dict.fromkeys(['date_formatted', 'trips'] + WEATHER_VARS + HISTORY_VARS + FLAGS + CATEGORICAL_VARS + ARIMA_FEATURES))
+HOURLY_FIT_COLUMNS = ['date_formatted', 'datetime', 'trips'] + WEATHER_VARS + HOURLY_WEATHER_VARS + HOURLY_HISTORY_VARS + HOUR_VARS + FLAGS + CATEGORICAL_VARS
+
+
+def load_data(path='trips_preprocessed', columns=None):
+    """Load preprocessed trip data from the CSV file or from a Parquet dataset directory, reading only columns if given.
+    Columns that are not in the dataset are skipped."""
+
+    if os.path.isdir(path):
+        from utils.storage import dataset_columns, read_dataset
+
+        if columns is not None:
+            available = set(dataset_columns(path))
+            columns = [col for col in columns if col in available]
+        trips_preprocessed = read_dataset(path, columns=columns)
+    else:
+        trips_preprocessed = pd.read_csv(path, usecols=None if columns is None else lambda col: col in set(columns))
     return trips_preprocessed
 
 def select_train_test_indexes(trips_preprocessed):
@@ -40,21 +89,37 @@ def generate_train_test_xgboost(trips_preprocessed, idx_train, idx_test):
 
 
 
-def fit_xgboost_model(X_train, y_train):
-    """Train an XGBoost model with selected features."""
+def fit_xgboost_model(X_train, y_train, granularity='quadrant', resolution='daily'):
+    """Train an XGBoost model with selected features.
+
+    With granularity 'comunas' or 'station' the quadrant column holds hundreds of series: the one-hot encoding stays sparse,
+    and series not seen in training (e.g. new stations) are encoded as all zeros instead of failing.
+    With resolution 'hourly' the model uses the hour, the hourly history and the hourly weather in X_train.
+    """
+
+    import xgboost as xgb
+
+    if granularity == 'quadrant':
+        series_encoder = OneHotEncoder()
+    else:
+        series_encoder = OneHotEncoder(handle_unknown='ignore')
 
-    weather_vars = ['weather_code (wmo code)', 'temperature_2m_mean (°C)', 'temperature_2m_max (°C)', 'precipitation_sum (mm)', 'precipitation_hours (h)', 'wind_speed_10m_max (km/h)','ratio_temp_max_to_avg_last_7_days']
-    history_vars = ['avg_trips_last_week', 'avg_trips_last_month', 'trips_same_day_last_week']
-    flags = ['is_weekend','is_holiday']
-    categorical_vars = ['quadrant']
+    if resolution == 'hourly':
+        hourly_weather = [col for col in HOURLY_WEATHER_VARS if col in X_train.columns]
+        transformers = [
+            ('weather', SimpleImputer(strategy='mean'), WEATHER_VARS + hourly_weather),
+            ('history', SimpleImputer(strategy='mean'), HOURLY_HISTORY_VARS),
+            ('flags', SimpleImputer(strategy='most_frequent'), FLAGS + HOUR_VARS),
+        ]
+    else:
+        transformers = [
+            ('weather', SimpleImputer(strategy='mean'), WEATHER_VARS),
+            ('history', SimpleImputer(strategy='mean'), HISTORY_VARS),
+            ('flags', SimpleImputer(strategy='most_frequent'), FLAGS),
+        ]
 
     preprocessor = ColumnTransformer(
-        transformers=[
-            ('weather', SimpleImputer(strategy='mean'), weather_vars),
-            ('history', SimpleImputer(strategy='mean'), history_vars),
-            ('flags', SimpleImputer(strategy='most_frequent'), flags),
-            ('cat', OneHotEncoder(), categorical_vars)
-        ],
+        transformers=transformers + [('cat', series_encoder, CATEGORICAL_VARS)],
         remainder='drop'
         )
 
@@ -74,7 +139,8 @@ def fit_xgboost_model(X_train, y_train):
     ])
 
     # Fit the model using the pipeline
-    pipeline.fit(X_train, y_train)
+    with instrument(pipeline, 'fit_xgboost_model'):
+        pipeline.fit(X_train, y_train)
     print(pipeline['xgb'].get_params())
     return pipeline
 
@@ -91,7 +157,9 @@ def generate_arima_sets(trips_preprocessed, idx_train, idx_test):
 def train_autoarima(ts_train):
     """Train an auto-arima model with selected exogenous features"""
 
-    features = ['is_weekend','is_holiday','precipitation_hours (h)', 'temperature_2m_mean (°C)']
+    from pmdarima import auto_arima
+
+    features = ARIMA_FEATURES
     target = ['trips']
 
     # iterate through the quadrant to train a time series for each
@@ -101,7 +169,7 @@ def train_autoarima(ts_train):
 
     for q in quadrants:
         series = ts_train[ts_train.quadrant==q]
-        model_arima = auto_arima(series[target], exogenous=series[features], suppress_warnings=True)
+        model_arima = auto_arima(series[target], X=series[features], suppress_warnings=True)
         arima_models[q] = model_arima
 
     return arima_models
@@ -109,52 +177,74 @@ def train_autoarima(ts_train):
 
 
 def evaluate(y_pred, y, set_name, **kwargs):
-    """Evaluate predictions from a regression model with RMSE (Root Mean Squared Error) and MAPE (Mean Average Percentage Error)"""
+    """Evaluate predictions from a regression model with RMSE (Root Mean Squared Error), WAPE (Weighted Absolute Percentage
+    Error), sMAPE (Symmetric Mean Absolute Percentage Error) and MAPE (Mean Absolute Percentage Error, without the actual
+    values of 0)"""
 
     # Evaluate the model
-    rmse = mean_squared_error(y, y_pred, squared=False)
-    mape = mean_absolute_percentage_error(y, y_pred)
-
-    print(f'{set_name} - Root Mean Squared Error:       {rmse}')
-    print(f'{set_name} - Mean Absolute Percetage Error: {mape}')
+    metrics = compute_metrics(prediction_table(y_pred, y, model=set_name), by=[])
+    print_metrics(metrics.iloc[0], set_name)
 
     return y_pred
 
 
-def evaluate_xgboost(model, X_train, y_train, X_test, y_test):
-    """Evaluate the XGBoost model for train and test."""
+def print_metrics(metrics, set_name):
+    print(f'{set_name} - Root Mean Squared Error:                     {metrics["rmse"]}')
+    print(f'{set_name} - Weighted Absolute Percentage Error:          {metrics["wape"]}')
+    print(f'{set_name} - Symmetric Mean Absolute Percentage Error:    {metrics["smape"]}')
+    print(f'{set_name} - Mean Absolute Percetage Error (actual != 0): {metrics["mape"]}')
 
-    y_pred = model.predict(X_train)
-    y_pred_tr = evaluate(y_pred, y_train, set_name='Train')
-    
-    y_pred = model.predict(X_test)
-    y_pred_ts = evaluate(y_pred, y_test, set_name='Test')
 
+def test_horizon(dates):
+    """Days ahead of each date from the first test day, 1 for the first day"""
+    dates = pd.to_datetime(pd.Series(np.asarray(dates)))
+    return (dates - dates.min()).dt.days.to_numpy() + 1
 
-def evaluate_arima(arima_models, ts_test, test_days=61):
-    """Evaluate the auto arima models for each quadrant, and for all the predictions combined."""
 
-    # Initialize an array to store the predictions
-    y_pred_values = []
-    y_test_values = []
+def evaluate_xgboost(model, X_train, y_train, X_test, y_test, name='xgboost'):
+    """Evaluate the XGBoost model for train and test. Returns the test predictions in long format.
+    The history features use the actual trips of the previous days, so every prediction is one day ahead."""
 
-    # Iterate through each quadrant model
-    for key, model in arima_models.items():
-        forecast = model.predict(n_periods=test_days)
+    with instrument(model, 'evaluate_xgboost'):
+        y_pred = model.predict(X_train)
+        y_pred_tr = evaluate(y_pred, y_train, set_name='Train')
 
-        y_pred_q = forecast.tolist()
-        y_test_q = ts_test.loc[ts_test.quadrant == key, 'trips'].tolist()
-        
-        # Evaluate each quadrant
-        evaluate(y_pred_q, y_test_q, set_name=f'Test {key}')
+        y_pred = model.predict(X_test)
+        y_pred_ts = evaluate(y_pred, y_test, set_name='Test')
 
-        # Concatenate the predictions to the array
-        y_pred_values.extend(y_pred_q)
-        y_test_values.extend(y_test_q)
+    return prediction_table(y_pred_ts, y_test, model=name, group=X_test['quadrant'])
 
-    # Evaluate the predictions from all the quadrants
-    evaluate(y_pred_values, y_test_values, set_name='Test')
-    return
+
+def evaluate_recursive(model, X_train, X_test, y_test, name='xgboost_recursive'):
+    """Evaluate the XGBoost model forecasting the whole test period from the train history,
+    with its own predictions in the rolling trip features instead of the actual trips"""
+    from utils.forecast import RecursiveForecaster
+
+    forecaster = RecursiveForecaster(model).fit(X_train)
+    forecast = trace('evaluate_recursive.predict', forecaster.predict, X_test)
+    evaluate(forecast['prediction'], y_test, set_name='Test recursive')
+    return prediction_table(forecast['prediction'], y_test, model=name, group=X_test['quadrant'],
+                            horizon=test_horizon(X_test['date_formatted']))
+
+
+def evaluate_arima(arima_models, ts_test, test_days=61, name='arima'):
+    """Evaluate the auto arima models for each quadrant, and for all the predictions combined.
+    Returns the predictions in long format."""
+
+    # Predictions of every quadrant in one table
+    tables = []
+    for key, model in arima_models.items():
+        X_test_q = ts_test.loc[ts_test.quadrant == key, ARIMA_FEATURES].iloc[:test_days]
+        forecast = model.predict(n_periods=test_days, X=X_test_q)
+        y_test_q = ts_test.loc[ts_test.quadrant == key, 'trips']
+        tables.append(prediction_table(forecast, y_test_q, model=name, group=key, horizon=np.arange(1, test_days + 1)))
+    predictions = pd.concat(tables, ignore_index=True)
+
+    # Evaluate each quadrant, and the predictions from all the quadrants
+    for _, metrics in compute_metrics(predictions, by=['group']).iterrows():
+        print_metrics(metrics, f'Test {metrics["group"]}')
+    print_metrics(compute_metrics(predictions, by=[]).iloc[0], 'Test')
+    return predictions
 
 def save_model(model, name):
     """Save the trained models in .pkl files"""
@@ -174,23 +264,11 @@ def save_model(model, name):
 def fine_tuning_xgboost(X_train, y_train, xgboost_pipeline):
     """Run a random search for XGBoost hiperparameters and return the best estimatos"""
 
-    # Define a parameter distribution for random search
-    param_dist = {
-        'xgb__n_estimators': [50, 100, 150],
-        'xgb__learning_rate': [0.01, 0.1, 0.2],
-        'xgb__max_depth': [3, 5, 7],
-        'xgb__min_child_weight': [1, 3, 5, 8, 10, 13, 15],
-        'xgb__subsample': [0.8, 1.0],
-        'xgb__colsample_bytree': [0.8, 1.0],
-        'xgb__gamma': [0, 1, 2],
-        'xgb__reg_alpha': [0, 0.1, 0.5],
-        'xgb__reg_lambda': [0.1, 1, 2],
-    }
-
     # Perform random search with RMSE as the scoring metric
-    random_search = RandomizedSearchCV(estimator=xgboost_pipeline, param_distributions=param_dist, 
+    random_search = RandomizedSearchCV(estimator=xgboost_pipeline, param_distributions=PARAM_DIST, 
                                     n_iter=50, scoring='neg_root_mean_squared_error', cv=3, random_state=42)
-    random_search.fit(X_train, y_train)
+    # the candidates are fit on clones of the pipeline, so the search is traced as a single stage
+    trace('fine_tuning_xgboost.search.fit', random_search.fit, X_train, y_train)
 
     # Get the best parameters
     best_params = random_search.best_params_
@@ -201,32 +279,173 @@ def fine_tuning_xgboost(X_train, y_train, xgboost_pipeline):
     return random_search.best_estimator_
 
 
+def time_ordered_splits(dates, n_splits=3):
+    """Split rows in expanding train / test folds ordered by date. All the rows of a day fall in the same fold."""
 
-def main():
-    trips_preprocessed = load_data()
-    idx_train, idx_test = select_train_test_indexes(trips_preprocessed)
+    dates = np.asarray(dates)
+    days = np.unique(dates)
 
-    # Train the XGBoost model
-    print('training xgboost model')
-    X_train, y_train, X_test, y_test = generate_train_test_xgboost(trips_preprocessed, idx_train, idx_test)
-    xgb_model = fit_xgboost_model(X_train, y_train)
-    
-    evaluate_xgboost(xgb_model, X_train, y_train, X_test, y_test)
-    save_model(xgb_model, 'xgboost_model')
+    splits = []
+    for train_days, test_days in TimeSeriesSplit(n_splits=n_splits).split(days):
+        train_idx = np.flatnonzero(dates <= days[train_days[-1]])
+        test_idx = np.flatnonzero((dates >= days[test_days[0]]) & (dates <= days[test_days[-1]]))
+        splits.append((train_idx, test_idx))
+    return splits
+
+
+def fine_tuning_xgboost_halving(X_train, y_train, xgboost_pipeline, n_candidates=50, max_estimators=150, n_splits=3, n_jobs=-1):
+    """Run a successive halving search for XGBoost hiperparameters over time ordered folds and return the best estimator.
+
+    n_estimators is used as the budget: every candidate starts with a few trees and only the best third of each round
+    moves on with 3 times more trees, up to max_estimators. The fitted preprocessing of each fold is cached, so it is
+    built once per fold instead of once per candidate, and candidates are fit in parallel on n_jobs cores.
+    """
+
+    from joblib import Memory
+    from sklearn.base import clone
+    from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+    from sklearn.model_selection import HalvingRandomSearchCV
 
-    # Fine-tune parameters with Random Search
-    print('fine tuning xgboost')
-    tuned_xgb_model = fine_tuning_xgboost(X_train, y_train, xgb_model)
-    evaluate_xgboost(tuned_xgb_model, X_train, y_train, X_test, y_test)
-    save_model(tuned_xgb_model, 'tuned_xgboost_model')
+    param_dist = {param: values for param, values in PARAM_DIST.items() if param != 'xgb__n_estimators'}
+    xgb_n_jobs = xgboost_pipeline['xgb'].get_params()['n_jobs']
 
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # one thread per candidate, the search runs the candidates in parallel
+        pipeline = clone(xgboost_pipeline).set_params(memory=Memory(cache_dir, verbose=0), xgb__n_jobs=1)
+
+        halving_search = HalvingRandomSearchCV(estimator=pipeline, param_distributions=param_dist, n_candidates=n_candidates,
+                                               resource='xgb__n_estimators', min_resources='exhaust', max_resources=max_estimators,
+                                               factor=3, scoring='neg_root_mean_squared_error', cv=time_ordered_splits(X_train['date_formatted'], n_splits),
+                                               n_jobs=n_jobs, random_state=42)
+        trace('fine_tuning_xgboost_halving.search.fit', halving_search.fit, X_train, y_train)
+
+    # Get the best parameters
+    best_params = halving_search.best_params_
+    print(best_params)
+
+    return halving_search.best_estimator_.set_params(memory=None, xgb__n_jobs=xgb_n_jobs)
+
+
+
+def main(argv=None, steps=('train-xgb', 'tune', 'train-arima')):
+    parser = argparse.ArgumentParser(description='Train and evaluate the XGBoost and auto-arima models')
+    parser.add_argument('--data', default='trips_preprocessed',
+                        help='preprocessed dataset, a CSV file or a Parquet dataset directory')
+    parser.add_argument('--granularity', choices=['quadrant', 'comunas', 'station'], default='quadrant',
+                        help='series the dataset was preprocessed for')
+    parser.add_argument('--resolution', choices=['daily', 'hourly'], default='daily',
+                        help='resolution the dataset was preprocessed with, trips by hour only train the XGBoost models')
+    parser.add_argument('--backtest', action='store_true',
+                        help='also run a weekly walk-forward backtest of the auto-arima models over the test period')
+    parser.add_argument('--recursive', action='store_true',
+                        help='also evaluate the XGBoost models forecasting the test period recursively, feeding their predictions back into the rolling trip features')
+    parser.add_argument('--metrics', default=None,
+                        help='save the test metrics of every model by fold, series and horizon to this CSV file')
+    parser.add_argument('--n-jobs', type=int, default=None, help='processes used by the backtest and the halving search, all cores by default')
+    parser.add_argument('--tuning', choices=['random', 'halving'], default='random',
+                        help='random search over shuffled folds, or successive halving over time ordered folds')
+    parser.add_argument('--trace', default=None,
+                        help='save a JSON trace with the time, rows and memory of each pipeline step to this file')
+    parser.add_argument('--profile-stage', default=None,
+                        help='run the traced stages starting with this name under cProfile, e.g. fit_xgboost_model.xgb')
+    args = parser.parse_args(argv)
+
+    # Trace the pipeline steps only when asked
+    tracer = StageTracer(profile_stage=args.profile_stage) if args.trace or args.profile_stage else None
+    with tracer.activate() if tracer else nullcontext():
+        try:
+            run(args, steps)
+        finally:
+            if tracer and args.trace:
+                tracer.save(args.trace)
+
+
+def run(args, steps=('train-xgb', 'tune', 'train-arima')):
+    """Train and evaluate the models with the options parsed in main"""
+
+    if args.recursive and args.resolution == 'hourly':
+        raise ValueError('--recursive only supports the daily resolution')
+
+    # models for other granularities and resolutions are saved next to the daily quadrant models
+    suffix = '' if args.granularity == 'quadrant' else f'_{args.granularity}'
+    if args.resolution == 'hourly':
+        suffix += '_hourly'
+
+    trips_preprocessed = load_data(args.data, columns=HOURLY_FIT_COLUMNS if args.resolution == 'hourly' else FIT_COLUMNS)
+    idx_train, idx_test = select_train_test_indexes(trips_preprocessed)
+
+    if 'train-xgb' in steps or 'tune' in steps:
+        # Train the XGBoost model
+        print('training xgboost model')
+        X_train, y_train, X_test, y_test = generate_train_test_xgboost(trips_preprocessed, idx_train, idx_test)
+        xgb_model = fit_xgboost_model(X_train, y_train, granularity=args.granularity, resolution=args.resolution)
+
+    # test predictions of every model, in long format
+    predictions = []
+
+    if 'train-xgb' in steps:
+        predictions.append(evaluate_xgboost(xgb_model, X_train, y_train, X_test, y_test))
+        if args.recursive:
+            predictions.append(evaluate_recursive(xgb_model, X_train, X_test, y_test))
+        save_model(xgb_model, f'xgboost_model{suffix}')
+        save_xgboost_artifact(xgb_model, f'models/xgboost_model{suffix}', X=X_test)
+
+    if 'tune' in steps:
+        # Fine-tune parameters with Random Search
+        print('fine tuning xgboost')
+        if args.tuning == 'halving':
+            tuned_xgb_model = fine_tuning_xgboost_halving(X_train, y_train, xgb_model, n_jobs=args.n_jobs or -1)
+        else:
+            tuned_xgb_model = fine_tuning_xgboost(X_train, y_train, xgb_model)
+        predictions.append(evaluate_xgboost(tuned_xgb_model, X_train, y_train, X_test, y_test, name='tuned_xgboost'))
+        if args.recursive:
+            predictions.append(evaluate_recursive(tuned_xgb_model, X_train, X_test, y_test, name='tuned_xgboost_recursive'))
+        save_model(tuned_xgb_model, f'tuned_xgboost_model{suffix}')
+        save_xgboost_artifact(tuned_xgb_model, f'models/tuned_xgboost_model{suffix}', X=X_test)
+
+    if 'train-arima' in steps:
+        predictions += run_arima(args, trips_preprocessed, idx_train, idx_test, suffix)
+
+    if predictions:
+        compare_models(pd.concat(predictions, ignore_index=True), args.metrics)
+
+
+def run_arima(args, trips_preprocessed, idx_train, idx_test, suffix=''):
+    """Train and evaluate the auto-arima models, and backtest them if asked. Returns their test predictions in long format"""
+
+    # Train the AutoArima Model, one per series, which is only practical for quadrants and comunas
+    if args.granularity == 'station':
+        print('skipping autoarima model for station granularity')
+        return []
+    if args.resolution == 'hourly':
+        print('skipping autoarima model for hourly resolution')
+        return []
 
-    # Train the AutoArima Model
     print('training autoarima model')
     ts_train, ts_test = generate_arima_sets(trips_preprocessed, idx_train, idx_test)
     arima_models = train_autoarima(ts_train)
-    evaluate_arima(arima_models, ts_test, test_days=61)
-    save_model(arima_models, 'arima_model')
+    predictions = [evaluate_arima(arima_models, ts_test, test_days=61)]
+    save_model(arima_models, f'arima_model{suffix}')
+
+    # Refit the AutoArima models weekly through the test period, comparable to the XGBoost features
+    if args.backtest:
+        from utils.backtest import backtest_autoarima
+
+        print('walk-forward backtest of autoarima models')
+        backtest = backtest_autoarima(trips_preprocessed, ARIMA_FEATURES, start='2022-11-01', step_days=7, n_jobs=args.n_jobs)
+        evaluate(backtest['prediction'], backtest['trips'], set_name='Backtest')
+        predictions.append(prediction_table(backtest['prediction'], backtest['trips'], model='arima_backtest',
+                                            group=backtest['quadrant'], fold=backtest['fold'], horizon=backtest['horizon']))
+    return predictions
+
+
+def compare_models(predictions, path=None):
+    """Print the test metrics of each model, and save the metrics by model, fold, series and horizon to path"""
+
+    print(compute_metrics(predictions, by=['model']).to_string(index=False))
+    if path:
+        compute_metrics(predictions).to_csv(path, index=False)
+        print(f'metrics saved in {path}')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
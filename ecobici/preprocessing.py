@@ -1,3 +1,11 @@
+import argparse
+import glob
+import io
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
 import pandas as pd
 import numpy as np
 
@@ -6,46 +14,393 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import FunctionTransformer
 import holidays
 
-from utils.preprocessor import AddQuadrantColumn, DatetimeTransformer, DateFeaturesTransformer, TimeFeaturesTransformer, AverageTempLast7DaysTransformer, RatioTempTransformer, RollingAveragesTransformer, MergeHolidaysTransformer, ReplaceOutliersByDayOfWeek
+from utils.instrumentation import StageTracer, instrument, trace
+from utils.preprocessor import AddQuadrantColumn, DatetimeTransformer, DateFeaturesTransformer, AverageTempLast7DaysTransformer, RatioTempTransformer, RollingAveragesTransformer, HourlyRollingAveragesTransformer, MergeHolidaysTransformer, ReplaceOutliersByDayOfWeek
+
+TRIPS_PATH = 'data/trips_2022.csv'
+# Daily weather files from open-meteo, one or more files covering the years of the trips
+WEATHER_PATH = 'weather/open-meteo-*.csv'
+STATE_PATH = 'preprocessing_state.pkl'
+# First day of the test partition of fit.py, the outlier bounds are fitted on the days before it
+TRAIN_END = '2022-11-01'
+
+# Columns of the trips file used to count trips by date and quadrant
+TRIP_COLUMNS = ['fecha_origen_recorrido', 'lat_estacion_origen', 'long_estacion_origen']
+# Origin station column, the series key of the station granularity
+STATION_COLUMN = 'id_estacion_origen'
+# Station columns of each end of the trips, read to count origin - destination flows
+FLOW_STATION_COLUMNS = {
+    'origin': ['id_estacion_origen', 'lat_estacion_origen', 'long_estacion_origen'],
+    'destination': ['id_estacion_destino', 'lat_estacion_destino', 'long_estacion_destino'],
+}
+
 
 def load_data():
     """Read datasets for trips, weather and holidays"""
     # load trips data for 2022
-    trips = pd.read_csv('data/trips_2022.csv').iloc[:,2:]
+    trips = load_trips(TRIPS_PATH)
 
-    # load weather data for 2022
-    weather = pd.read_csv('weather/open-meteo-34.62S58.41W19m.csv', delimiter=';')
+    weather, ar_holidays = load_weather_holidays()
 
-    # load holidays in argentina for 2022
-    ar_holidays = holidays.Argentina(years=2022)
+    return trips, weather, ar_holidays
+
+def load_trips(path=TRIPS_PATH, compact=False):
+    """Read the trips dataset.
+    With compact=True only the columns used to count trips are read, and the origin station is categorical."""
+    if compact:
+        return pd.read_csv(path, usecols=TRIP_COLUMNS + [STATION_COLUMN], dtype={STATION_COLUMN: 'category'})
+    return pd.read_csv(path).iloc[:,2:]
+
+def load_weather_holidays(years=2022, compact=False):
+    """Read datasets for weather and holidays.
+    With compact=True the weather variables are float32 and the weather code int16."""
+    # load weather data for the years, from every weather file
+    weather = load_weather(WEATHER_PATH, years)
+    if compact:
+        weather = compact_weather(weather)
+
+    # load holidays in argentina for the years
+    ar_holidays = holidays.Argentina(years=years)
     ar_holidays = pd.DataFrame(ar_holidays.items(), columns=['Date', 'Holiday'])
     ar_holidays['Date'] = ar_holidays['Date'].astype('str')
 
-    return trips, weather, ar_holidays
+    return weather, ar_holidays
+
+def load_weather(pattern=WEATHER_PATH, years=2022):
+    """Read and concatenate the daily weather files matching pattern, keeping one row per day (the one of the last file)"""
+
+    weather = pd.concat([pd.read_csv(path, delimiter=';') for path in sorted(glob.glob(pattern))], ignore_index=True)
+    weather = weather.drop_duplicates('time', keep='last').sort_values('time').reset_index(drop=True)
+
+    missing = sorted(set([years] if isinstance(years, int) else years) - set(weather['time'].str[:4].astype(int)))
+    if missing:
+        print(f'no weather for years {missing}, add their open-meteo files to {os.path.dirname(pattern)}')
+    return weather
+
+def compact_weather(weather):
+    """Downcast the weather variables: float32 measurements and int16 weather code"""
+    numeric = weather.select_dtypes('number').columns
+    return weather.astype({col: 'float32' if weather[col].dtype.kind == 'f' else 'int16' for col in numeric})
+
+def load_hourly_weather(path):
+    """Read hourly weather, with the hour of each row in a datetime column to join on"""
+    weather = pd.read_csv(path, delimiter=';')
+    weather['datetime'] = pd.to_datetime(weather.pop('time')).dt.floor('h')
+    return weather
+
+def preprocess_data(trips, weather, ar_holidays, granularity='quadrant', cache=None, compact=False, resolution='daily', hourly_weather=None, fit_end=TRAIN_END):
+    """Generate dataset with total trips by date and quadrant, and add new features.
+
+    granularity sets the series to forecast: 'quadrant' (4 quadrants), 'comunas' (comuna polygons) or 'station' (origin stations).
+    The series key is stored in the quadrant column for every granularity.
+    resolution='hourly' counts trips by hour instead of by day, with every hour of every series (0 when there were no trips),
+    hour-aware rolling features, and the hourly weather from load_hourly_weather when given.
+    cache is an optional utils.cache.StageCache, the output of each pipeline step is loaded from it when already computed.
+    With compact=True the series key is categorical (pass weather from load_weather_holidays(compact=True) to also
+    keep the weather as float32).
+    """
+
+    trips_dt_quadrant = aggregate_trips(trips, granularity=granularity, cache=cache, compact=compact, resolution=resolution)
+    return add_features(trips_dt_quadrant, weather, ar_holidays, cache=cache, resolution=resolution, hourly_weather=hourly_weather, fit_end=fit_end)
+
 
-def preprocess_data(trips, weather, ar_holidays):
-    """Generate dataset with total trips by date and quadrant, and add new features"""
+def run_pipeline(pipeline, X, method='fit_transform', cache=None, input_key=None, name='pipeline'):
+    """Run the pipeline, through the stage cache when there is one, tracing its steps as name.step when a tracer is active.
+    Returns the output and its cache key (None without cache)."""
+
+    with instrument(pipeline, name):
+        if cache is None:
+            return getattr(pipeline, method)(X), None
+        return cache.run(pipeline, X, method=method, input_key=input_key)
+
+
+def aggregate_trips(trips, granularity='quadrant', cache=None, compact=False, resolution='daily'):
+    """Assign a quadrant to each trip and count trips by date (or hour) and quadrant"""
 
     # Create and apply a pipeline for classifying origin stations in a quadrant
     quadrant_classifier_pipeline = Pipeline([
-        ('add_quadrant', AddQuadrantColumn())
+        ('add_quadrant', AddQuadrantColumn(mode=granularity, categorical=compact))
     ])
-    trips_transformed = quadrant_classifier_pipeline.fit_transform(trips)
+    trips_transformed, key = run_pipeline(quadrant_classifier_pipeline, trips, cache=cache, name='quadrant')
     print('added quadrant')
 
-    # Create and apply a pipeline for extracting features from datetime stamp
+    # Parse the datetime stamp. The date features are computed by date_quadrant_table on the counted rows, not per trip
     datetime_pipeline = Pipeline([
         ('datetime_transformer', DatetimeTransformer()),
-        ('date_features_transformer', DateFeaturesTransformer()),
-        ('time_features_transformer', TimeFeaturesTransformer())
     ])
-    trips_dt = datetime_pipeline.transform(trips_transformed)
-    print('added datetime features')
+    trips_dt, key = run_pipeline(datetime_pipeline, trips_transformed, method='transform', cache=cache, input_key=key, name='datetime')
+    print('parsed datetime')
     
     # Generate a dataframe with date - quadrant cardinality, to predict trips by quadrant and day
-    trips_dt_quadrant = trips_dt[['month','date_formatted', 'weekday','is_weekend','quadrant']].value_counts().reset_index().rename(columns={0:'trips'})
+    unit = 'h' if resolution == 'hourly' else 'D'
+    counts = trace('count_trips', count_trips, trips_dt['fecha_origen_recorrido'], trips_dt['quadrant'], unit=unit)
+    trips_dt_quadrant = date_quadrant_table(counts, compact=compact, hourly=resolution == 'hourly')
+    print('grouped by date and quadrant')
+
+    return trips_dt_quadrant
+
+
+def count_trips(dates, quadrants, unit='D'):
+    """Count trips by date and quadrant, binning integer day and quadrant codes instead of grouping by strings.
+    With unit='h' trips are counted by hour.
+    Returns a series of trips indexed by (fecha_origen_recorrido, quadrant), only for the pairs with trips."""
+
+    quadrant_codes, quadrant_labels = pd.factorize(quadrants)
+    periods = dates.to_numpy().astype(f'datetime64[{unit}]')
+
+    # trips without date or quadrant are not counted
+    valid = (quadrant_codes >= 0) & ~np.isnat(periods)
+    periods = periods[valid].astype('int64')
+    quadrant_codes = quadrant_codes[valid]
+
+    n_quadrants = len(quadrant_labels)
+    first_period = periods.min() if len(periods) else 0
+    counts = np.bincount((periods - first_period) * n_quadrants + quadrant_codes)
+    bins = np.flatnonzero(counts)
+
+    index = pd.MultiIndex.from_arrays([
+        pd.to_datetime(first_period + bins // n_quadrants, unit=unit),
+        np.asarray(quadrant_labels, dtype=object)[bins % n_quadrants]
+    ], names=['fecha_origen_recorrido', 'quadrant'])
+    return pd.Series(counts[bins], index=index, name='trips')
+
+
+def complete_periods(counts, unit='D', quadrants=None, start=None):
+    """Add the days (or hours with unit='h') without trips to the counts, for every day or hour of every day from the
+    first to the last day and every quadrant, so each series has one row per period and the rolling windows, which
+    count rows, span calendar days or hours. This matters for stations, which have days without trips.
+    quadrants and start add series and days without trips before the first counted day, e.g. the series and the day
+    after the last preprocessed day of an incremental run."""
+
+    periods = counts.index.get_level_values(0)
+    quadrant_codes, quadrant_labels = pd.factorize(counts.index.get_level_values(1))
+    if quadrants is not None:
+        quadrant_labels = pd.Index(np.asarray(quadrants, dtype=object))
+        quadrant_labels = quadrant_labels.append(pd.Index(np.asarray(pd.unique(counts.index.get_level_values(1)), dtype=object)).difference(quadrant_labels))
+        quadrant_codes = quadrant_labels.get_indexer(counts.index.get_level_values(1))
+    step = pd.Timedelta(1, unit=unit)
+    first_period = (periods.min() if start is None else pd.Timestamp(start)).floor('D')
+    all_periods = pd.date_range(first_period, periods.max().floor('D') + pd.Timedelta(days=1) - step, freq=step)
+
+    # dense table of periods x quadrants, filled from the integer codes of the counted pairs
+    period_codes = (periods - first_period) // step
+    dense = np.zeros(len(all_periods) * len(quadrant_labels), dtype='int64')
+    dense[period_codes * len(quadrant_labels) + quadrant_codes] = counts.to_numpy()
+
+    index = pd.MultiIndex.from_product([all_periods, np.asarray(quadrant_labels, dtype=object)], names=counts.index.names)
+    return pd.Series(dense, index=index, name='trips')
+
+
+def date_quadrant_table(counts, compact=False, hourly=False, quadrants=None, start=None):
+    """Build the dataset of trips by date and quadrant from the counts, computing date features once per row.
+    The days without trips of each quadrant are added with 0 trips. With compact=True the quadrant is categorical.
+    With hourly=True the counts are by hour: the hours without trips are added, and the table has the datetime of the
+    hour and the hour. quadrants and start are passed to complete_periods."""
+
+    counts = complete_periods(counts, unit='h' if hourly else 'D', quadrants=quadrants, start=start)
+    trips_dt_quadrant = counts.astype('int64').rename('trips').reset_index()
+    trips_dt_quadrant = DateFeaturesTransformer().transform(trips_dt_quadrant)
+    # dates are compared and merged as strings in the next steps
+    trips_dt_quadrant = trips_dt_quadrant.astype({'date_formatted': str, 'month': str, 'quadrant': 'category' if compact else object})
+
+    if hourly:
+        trips_dt_quadrant['datetime'] = trips_dt_quadrant['fecha_origen_recorrido']
+        trips_dt_quadrant['hour'] = trips_dt_quadrant['datetime'].dt.hour.astype('int8')
+        return trips_dt_quadrant[['month','date_formatted', 'datetime', 'hour', 'weekday','is_weekend','quadrant', 'trips']]
+    return trips_dt_quadrant[['month','date_formatted', 'weekday','is_weekend','quadrant', 'trips']]
+
+
+def aggregate_trips_chunked(path=TRIPS_PATH, chunksize=500_000, granularity='quadrant', compact=False, resolution='daily', after=None):
+    """Count trips by date and quadrant reading the trips file in chunks, so the full trips table is never loaded.
+
+    Only the origin timestamp and coordinates are read. Each chunk is reduced to date - quadrant counts, which are
+    merged into a running total, so memory depends on chunksize and not on the size of the file.
+    With after, only the trips of the days after that date are counted.
+    """
+
+    quadrant_classifier = AddQuadrantColumn(mode=granularity).fit(None)
+    columns = TRIP_COLUMNS + ([quadrant_classifier.station_column] if granularity == 'station' else [])
+
+    counts = None
+    for i, chunk in enumerate(pd.read_csv(path, usecols=columns, chunksize=chunksize)):
+        if after is not None:
+            chunk = select_new_trips(chunk, after)
+            if chunk.empty:
+                continue
+        partial_counts = count_chunk(chunk, quadrant_classifier, resolution=resolution)
+        counts = partial_counts if counts is None else counts.add(partial_counts, fill_value=0)
+        print(f'counted chunk {i}')
+
+    if counts is None:
+        return None
+
+    # Date features are computed once per date and quadrant, not per trip
+    trips_dt_quadrant = date_quadrant_table(counts, compact=compact, hourly=resolution == 'hourly')
+    print('grouped by date and quadrant')
+
+    return trips_dt_quadrant
+
+
+def select_new_trips(trips, after):
+    """Trips that start on the days after the date after ('%Y-%m-%d'), compared on the timestamp strings without parsing them"""
+
+    next_day = (pd.Timestamp(after) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    return trips[trips['fecha_origen_recorrido'] >= next_day]
+
+
+def count_chunk(chunk, quadrant_classifier, resolution='daily', name='chunked'):
+    """Assign the quadrant of the trips of a chunk and count them by date (or hour) and quadrant"""
+
+    chunk = trace(f'{name}.add_quadrant.transform', quadrant_classifier.transform, chunk)
+    dates = pd.to_datetime(chunk['fecha_origen_recorrido'], format=DatetimeTransformer().format)
+    return trace(f'{name}.count_trips', count_trips, dates, chunk['quadrant'], unit='h' if resolution == 'hourly' else 'D')
+
+
+def split_byte_ranges(path, block_bytes):
+    """Split a CSV file into ranges of about block_bytes that start and end at line boundaries.
+    Returns the header line and the (start, end) byte offsets of the ranges after it."""
+
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as file:
+        header = file.readline()
+        start = file.tell()
+        while start < size:
+            # the range ends at the end of the line that contains start + block_bytes
+            file.seek(min(start + block_bytes, size))
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+def line_bytes(path, n_lines=1000):
+    """Average size of the first lines of a file, to turn a chunk size in rows into bytes"""
+
+    with open(path, 'rb') as file:
+        file.readline()
+        lines = [len(line) for _, line in zip(range(n_lines), file)]
+    return max(sum(lines) // max(len(lines), 1), 1)
+
+
+# Quadrant classifier of each worker process, fitted once by init_worker (e.g. the comuna polygons)
+WORKER_CLASSIFIER = None
+
+
+def init_worker(granularity):
+    global WORKER_CLASSIFIER
+    WORKER_CLASSIFIER = AddQuadrantColumn(mode=granularity).fit(None)
+
+
+def count_byte_range(path, header, start, end, resolution='daily'):
+    """Parse the lines of a trips file between two byte offsets and count them by date (or hour) and quadrant.
+    Runs in the worker processes."""
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    chunk = pd.read_csv(io.BytesIO(header + data), usecols=TRIP_COLUMNS + [STATION_COLUMN])
+    return count_chunk(chunk, WORKER_CLASSIFIER, resolution=resolution, name='partitioned')
+
+
+def aggregate_trips_partitioned(paths, workers=None, chunksize=500_000, granularity='quadrant', compact=False, resolution='daily'):
+    """Count trips by date and quadrant for several trips files (e.g. several years) in a pool of workers processes
+    (all cores by default).
+
+    Each file is split into byte ranges of about chunksize lines, and each worker parses its own ranges and returns
+    their counts, so parsing, quadrant assignment and counting all run in parallel and memory depends on chunksize
+    and not on the size of the files. Trip lines must not contain line breaks inside quoted values.
+    The counts of the ranges are then summed in the date - quadrant table.
+    """
+
+    tasks = []
+    for path in paths:
+        header, ranges = split_byte_ranges(path, chunksize * line_bytes(path))
+        tasks += [(path, header, start, end) for start, end in ranges]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(granularity,)) as executor:
+        range_counts = list(executor.map(count_byte_range, *zip(*tasks), [resolution] * len(tasks)))
+    print(f'counted {len(tasks)} blocks of {len(paths)} files')
+
+    # a day can span two blocks, their counts are summed
+    counts = pd.concat(range_counts).groupby(level=[0, 1], sort=True).sum()
+    trips_dt_quadrant = date_quadrant_table(counts, compact=compact, hourly=resolution == 'hourly')
     print('grouped by date and quadrant')
 
+    return trips_dt_quadrant
+
+
+def aggregate_flows(path=TRIPS_PATH, granularity='station', resolution='daily', chunksize=None):
+    """Count origin - destination trips between the zones of the granularity (stations, quadrants or comunas) by day
+    or hour, as sparse FlowMatrices.
+
+    Trips are counted by origin and destination station in each chunk, and the stations are assigned to zones once
+    at the end, using the coordinates of each unique station. The period of a trip is the period of its origin timestamp.
+    """
+    from utils.flows import PERIOD_UNITS, build_flow_matrices, count_station_flows
+
+    unit = PERIOD_UNITS[resolution]
+    columns = ['fecha_origen_recorrido'] + FLOW_STATION_COLUMNS['origin'] + FLOW_STATION_COLUMNS['destination']
+    chunks = pd.read_csv(path, usecols=columns, chunksize=chunksize) if chunksize else [pd.read_csv(path, usecols=columns)]
+
+    counts = None
+    stations = []
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.dropna(subset=[FLOW_STATION_COLUMNS['origin'][0], FLOW_STATION_COLUMNS['destination'][0]])
+        periods = pd.to_datetime(chunk['fecha_origen_recorrido'], format=DatetimeTransformer().format)
+        periods = periods.to_numpy().astype(f'datetime64[{unit}]').astype(np.int64)
+
+        partial_counts = trace('flows.count_station_flows', count_station_flows, periods,
+                               chunk[FLOW_STATION_COLUMNS['origin'][0]].to_numpy(), chunk[FLOW_STATION_COLUMNS['destination'][0]].to_numpy())
+        counts = partial_counts if counts is None else counts.add(partial_counts, fill_value=0)
+        for end_columns in FLOW_STATION_COLUMNS.values():
+            stations.append(chunk[end_columns].drop_duplicates(end_columns[0]).set_axis(['id', 'lat', 'long'], axis=1))
+        print(f'counted flows of chunk {i}')
+
+    # zone of each station, from its coordinates
+    stations = pd.concat(stations).drop_duplicates('id').reset_index(drop=True)
+    stations = AddQuadrantColumn(mode=granularity, lat_column='lat', long_column='long', station_column='id').fit_transform(stations)
+    located = stations['quadrant'].notna()
+    zones = pd.Index(np.sort(stations.loc[located, 'quadrant'].unique()))
+    station_zones = pd.Series(np.where(located, zones.get_indexer(stations['quadrant']), -1), index=stations['id'])
+
+    counts = counts.astype(np.int64)
+    counts.index = counts.index.set_levels([station_zones.index.get_indexer(level) for level in counts.index.levels[1:]], level=[1, 2])
+
+    # stations without zone (e.g. outside every comuna) are left out, like the trips without quadrant in count_trips
+    if not located.all():
+        unlocated = ~located.to_numpy()
+        excluded = unlocated[counts.index.get_level_values(1)] | unlocated[counts.index.get_level_values(2)]
+        print(f'{(~located).sum()} stations without {granularity}, {counts[excluded].sum()} trips from or to them are not counted')
+    return build_flow_matrices(counts, station_zones.to_numpy(), zones, unit=unit)
+
+
+def add_features(trips_dt_quadrant, weather, ar_holidays, cache=None, resolution='daily', hourly_weather=None, outliers=None, fit_end=TRAIN_END):
+    """Add weather, holidays, rolling averages and outlier features to the trips by date and quadrant"""
+
+    trips_dt_wht = add_weather_features(trips_dt_quadrant, weather, cache=cache, hourly_weather=hourly_weather)
+    return add_history_features(trips_dt_wht, ar_holidays, cache=cache, resolution=resolution, outliers=outliers, fit_end=fit_end)
+
+
+def lookup_join(left, right, left_on, right_on):
+    """Left join that looks up each unique key of left in right, which has one row per key, instead of merging.
+    The rows keep the order of left and the index is reset, like a left merge."""
+
+    codes, keys = pd.factorize(left[left_on])
+    right = right.drop_duplicates(right_on).set_index(right_on, drop=right_on == left_on).reindex(keys)
+    joined = right.iloc[np.maximum(codes, 0)].reset_index(drop=True)
+
+    # rows without key (code -1) are left without values, like unmatched rows of a left merge
+    if (codes < 0).any():
+        joined.loc[codes < 0] = np.nan
+    return pd.concat([left.reset_index(drop=True), joined], axis=1)
+
+
+def add_weather_features(trips_dt_quadrant, weather, cache=None, hourly_weather=None):
+    """Add weather features to the trips by date and quadrant, sorted by date.
+    For trips by hour, the hourly weather (from load_hourly_weather) is also added by hour, its variables with the
+    same name as a daily one are suffixed with _hourly."""
 
     # Add features to the weather dataframe
     weather_pipeline = Pipeline([
@@ -53,43 +408,320 @@ def preprocess_data(trips, weather, ar_holidays):
         ('ratio_temp_max', RatioTempTransformer())
     ])
 
-    weather_transformed = weather_pipeline.fit_transform(weather)
+    weather_transformed, _ = run_pipeline(weather_pipeline, weather, cache=cache, name='weather')
 
     # Add weather features to the trips dataset
-    trips_dt_wht = trips_dt_quadrant.merge(weather_transformed, left_on='date_formatted', right_on='time', how='left')
+    trips_dt_wht = lookup_join(trips_dt_quadrant, weather_transformed, left_on='date_formatted', right_on='time')
+    if hourly_weather is not None:
+        hourly_weather = hourly_weather.rename(columns={col: f'{col}_hourly' for col in hourly_weather.columns if col in trips_dt_wht.columns and col != 'datetime'})
+        trips_dt_wht = lookup_join(trips_dt_wht, hourly_weather, left_on='datetime', right_on='datetime')
     print('added weather features')
 
-    # Sort by date
+    # Sort by date, and by hour for trips by hour
     trips_dt_wht['date'] = pd.to_datetime(trips_dt_wht['date_formatted'])
-    trips_dt_wht = trips_dt_wht.sort_values(by='date')
+    trips_dt_wht = trips_dt_wht.sort_values(by=['date', 'hour'] if 'hour' in trips_dt_wht.columns else 'date')
+
+    return trips_dt_wht
+
+
+def add_history_features(trips_dt_wht, ar_holidays, cache=None, resolution='daily', outliers=None, fit_end=TRAIN_END):
+    """Add rolling averages of trips, holidays and outlier features.
 
+    outliers is the ReplaceOutliersByDayOfWeek step to use, it is fitted here and can be saved by the caller to score
+    new days later. The step runs after the cached pipeline, so it is always fitted. It is fitted on the days before
+    fit_end (all the days when fit_end is None or there are none before it) and applied to all the days.
+    """
 
     # Add new features - Rolling averages of trips, Flag Holidays and Replace outliers
     # Outliers are identified by weekday and quadrant, and are replaced by the mean of that weekday and quadrant to keep all days in the series complete
+    # Trips by hour use hour-aware rolling features, and outliers are identified by weekday, hour and quadrant
+    if resolution == 'hourly':
+        rolling = HourlyRollingAveragesTransformer()
+        outliers = ReplaceOutliersByDayOfWeek(group_columns=('weekday', 'hour', 'quadrant')) if outliers is None else outliers
+    else:
+        rolling = RollingAveragesTransformer()
+        outliers = ReplaceOutliersByDayOfWeek() if outliers is None else outliers
+
     pipeline = Pipeline([
-        ('rolling_trip_avg', RollingAveragesTransformer()),
+        ('rolling_trip_avg', rolling),
         ('flag_holidays', MergeHolidaysTransformer(holidays_df=ar_holidays)),
-        ('flag_outlier', ReplaceOutliersByDayOfWeek())
     ])
 
-    trips_dt_wht_hol_transformed = pipeline.fit_transform(trips_dt_wht)
+    trips_dt_wht_hol, _ = run_pipeline(pipeline, trips_dt_wht, cache=cache, name='history')
+    train = trips_dt_wht_hol['date_formatted'] < fit_end if fit_end is not None else np.ones(len(trips_dt_wht_hol), dtype=bool)
+    if not train.any():
+        print(f'no days before {fit_end}, outlier bounds are fitted on all the days')
+        train = np.ones(len(trips_dt_wht_hol), dtype=bool)
+    trace('history.flag_outlier.fit', outliers.fit, trips_dt_wht_hol[train])
+    trips_dt_wht_hol_transformed = trace('history.flag_outlier.transform', outliers.transform, trips_dt_wht_hol)
     print('Added rolling averages, holidays and outliers')
 
     return trips_dt_wht_hol_transformed
 
 
-def write_data(trips_dt_wht_hol_transformed):
-    """Save preprocessed dataset"""
+ROLLING_COLUMNS = ['date', 'quadrant', 'is_weekend', 'weekday', 'trips']
+ROLLING_FEATURES = ['trips_last_day', 'avg_trips_last_week', 'avg_trips_last_month', 'trips_same_day_last_week']
+
+
+def select_rolling_tail(history, rolling=None):
+    """Select the last rows of each quadrant series that the rolling features of the next days depend on:
+    the longest rolling window of each series, and the same day lag of each weekday"""
+
+    rolling = rolling or RollingAveragesTransformer()
+    tail_days = max(rolling.weekday_month_window, rolling.weekday_week_window, rolling.weekend_month_window, rolling.weekend_week_window)
+    tail_weeks = max(rolling.weekday_same_day_lag, rolling.weekend_same_day_lag)
+
+    history = history.sort_values(by='date').reset_index(drop=True)
+    last_days = history.groupby(['quadrant', 'is_weekend'], observed=True).tail(tail_days).index
+    last_weeks = history.groupby(['quadrant', 'weekday'], observed=True).tail(tail_weeks).index
+    return history.loc[last_days.union(last_weeks)].reset_index(drop=True)
+
+
+def build_incremental_state(trips_dt_quadrant, weather, granularity='quadrant'):
+    """Build the state needed to preprocess new days without the full history:
+    - granularity: series the dataset was built for
+    - last_date: last preprocessed day
+    - rolling_tail: last trips of each quadrant series, for the rolling averages
+    - weather_tail: last 7 days of weather, for the rolling average of max temperature
+
+    The fitted outlier step and the end of its fit window are added to the state as 'outliers' and 'train_end' once
+    the features are computed.
+    """
+
+    history = trips_dt_quadrant.assign(date=pd.to_datetime(trips_dt_quadrant['date_formatted']))
+    last_date = trips_dt_quadrant['date_formatted'].max()
+
+    return {
+        'granularity': granularity,
+        'last_date': last_date,
+        'rolling_tail': select_rolling_tail(history[ROLLING_COLUMNS]),
+        'weather_tail': weather[weather['time'] <= last_date].sort_values(by='time').tail(7).reset_index(drop=True),
+    }
+
+
+def preprocess_incremental(trips_dt_quadrant, weather, ar_holidays, state):
+    """Generate features only for the days after state['last_date'], using the saved state instead of the full history.
 
-    path = 'trips_preprocessed'
-    trips_dt_wht_hol_transformed.to_csv(path)
+    Returns the new rows and the updated state. Rows that were already preprocessed are not modified.
+    The features are the ones a full rebuild would produce: outliers are flagged with the bounds saved in the state,
+    which a full rebuild fits on the same days before train_end. New days before train_end would be part of the fit
+    of a full rebuild, they are flagged with the saved bounds and a message is printed.
+    Every series of the state gets a row for each new day, with 0 trips on the days without trips. Series that first
+    appear in the new trips start from a history of 0 trips, like in a full rebuild, but their previous days are not
+    added to the saved dataset and they have no outlier bounds, so their outliers are left unchanged.
+    """
+
+    new_trips = trips_dt_quadrant[trips_dt_quadrant['date_formatted'] > state['last_date']]
+    if new_trips.empty:
+        print(f"no trips after {state['last_date']}")
+        return None, state
+    new_trips = complete_new_days(new_trips, state)
+
+    # Weather features, the last days of weather are prepended for the rolling average of max temperature
+    weather_window = pd.concat([state['weather_tail'], weather[weather['time'] > state['last_date']]], ignore_index=True)
+    weather_columns = state['weather_tail'].columns
+    new_rows = add_weather_features(new_trips, weather_window.copy()).reset_index(drop=True)
+
+    # Rolling averages, computed over the tail of each quadrant series followed by the new days. Series without
+    # history had 0 trips on the previous days in a full rebuild
+    tail = state['rolling_tail']
+    new_series = new_rows.loc[~new_rows['quadrant'].isin(tail['quadrant']), 'quadrant'].unique()
+    if len(new_series) and len(tail):
+        template = tail[tail['quadrant'] == tail['quadrant'].iloc[0]]
+        tail = pd.concat([tail] + [template.assign(quadrant=series, trips=0) for series in new_series], ignore_index=True)
+    history = pd.concat([tail, new_rows[ROLLING_COLUMNS]], ignore_index=True)
+    rolling = RollingAveragesTransformer().fit_transform(history.copy())
+    for col in ROLLING_FEATURES:
+        new_rows[col] = rolling[col].to_numpy()[-len(new_rows):]
+
+    new_rows = MergeHolidaysTransformer(holidays_df=ar_holidays).fit_transform(new_rows)
+
+    # Outliers, looked up in the bounds fitted by the full run on the days before train_end
+    if new_rows['date_formatted'].min() < state['train_end']:
+        print(f"new days before {state['train_end']} are not in the outlier bounds, a full run would fit the bounds on them")
+    new_rows = state['outliers'].transform(new_rows)
+    print(f'preprocessed {len(new_rows)} new rows')
+
+    last_date = new_rows['date_formatted'].max()
+    state = {
+        'granularity': state['granularity'],
+        'last_date': last_date,
+        'rolling_tail': select_rolling_tail(history),
+        'weather_tail': weather_window.loc[weather_window['time'] <= last_date, weather_columns].sort_values(by='time').tail(7).reset_index(drop=True),
+        'outliers': state['outliers'],
+        'train_end': state['train_end'],
+    }
+    return new_rows, state
+
+
+def complete_new_days(new_trips, state):
+    """Add the rows without trips to the new trips by date and quadrant, for every series of the state and every day
+    from the day after state['last_date'] to the last new day, like a full rebuild adds them"""
+
+    counts = new_trips.set_index([pd.to_datetime(new_trips['date_formatted']).rename('fecha_origen_recorrido'), 'quadrant'])['trips']
+    return date_quadrant_table(counts, compact=isinstance(new_trips['quadrant'].dtype, pd.CategoricalDtype),
+                               quadrants=state['rolling_tail']['quadrant'].unique(),
+                               start=pd.Timestamp(state['last_date']) + pd.Timedelta(days=1))
+
+
+def save_state(state, path=STATE_PATH):
+    """Save the incremental preprocessing state"""
+
+    with open(path, 'wb') as file:
+        pickle.dump(state, file)
+    print(f'state saved in {path}')
+
+
+def load_state(path=STATE_PATH):
+    """Load the incremental preprocessing state"""
+
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def write_data(trips_dt_wht_hol_transformed, output_format='csv', append=False, name='trips_preprocessed'):
+    """Save preprocessed dataset, as a CSV file or as a Parquet dataset partitioned by month.
+    With append=True the rows are added to the existing dataset."""
+
+    if output_format == 'parquet':
+        from utils.storage import write_dataset
+
+        path = f'{name}.parquet'
+        write_dataset(trips_dt_wht_hol_transformed, path, append=append)
+    elif append:
+        path = name
+        # continue the index of the existing file
+        with open(path) as file:
+            n_rows = sum(1 for _ in file) - 1
+        trips_dt_wht_hol_transformed.index = range(n_rows, n_rows + len(trips_dt_wht_hol_transformed))
+        trips_dt_wht_hol_transformed.to_csv(path, mode='a', header=False)
+    else:
+        path = name
+        trips_dt_wht_hol_transformed.to_csv(path)
     print(f'saved in {path}')
 
 
-def main():
-    trips, weather, ar_holidays = load_data()
-    trips_dt_quadrant = preprocess_data(trips, weather, ar_holidays)
-    write_data(trips_dt_quadrant)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Preprocess the trips dataset and generate features by date and quadrant')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the trips file in chunks of this many rows instead of loading it at once')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='save the preprocessed dataset as CSV or as a Parquet dataset partitioned by month')
+    parser.add_argument('--trips', default=TRIPS_PATH,
+                        help='trips file to preprocess, or with --workers a glob pattern of several trips files (e.g. "data/trips_*.csv")')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parse and count blocks of the trips files in this many processes (0 for all cores), '
+                             'to preprocess several years with bounded memory')
+    parser.add_argument('--granularity', choices=['quadrant', 'comunas', 'station'], default='quadrant',
+                        help='series to forecast: quadrants, comuna polygons or origin stations')
+    parser.add_argument('--resolution', choices=['daily', 'hourly'], default='daily',
+                        help='count trips by day, or by hour with hour-aware features (saved in trips_preprocessed_hourly)')
+    parser.add_argument('--hourly-weather', default=None,
+                        help='hourly weather file, with a time column and ; as delimiter, joined by hour with --resolution hourly')
+    parser.add_argument('--flows', action='store_true',
+                        help='instead of the features, save origin - destination trip counts between the --granularity zones by day or hour '
+                             '(--resolution) as sparse matrices in flows_<granularity>')
+    parser.add_argument('--train-end', default=TRAIN_END,
+                        help='first day of the test partition, the outlier bounds are fitted on the days before it')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only preprocess the days after the last preprocessed day, and append them to the saved dataset')
+    parser.add_argument('--cache-dir', default=None,
+                        help='cache the output of each pipeline step in this directory, and reuse it when its input and parameters did not change')
+    parser.add_argument('--cache-size-mb', type=int, default=2048,
+                        help='maximum size of the cache, the least recently used outputs are deleted above it')
+    parser.add_argument('--compact', action='store_true',
+                        help='lower memory: read only the needed trip columns, categorical series keys and float32 weather')
+    parser.add_argument('--trace', default=None,
+                        help='save a JSON trace with the time, rows and memory of each pipeline step to this file')
+    parser.add_argument('--profile-stage', default=None,
+                        help='run the traced stages starting with this name under cProfile, e.g. datetime.datetime_transformer')
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache_dir:
+        from utils.cache import StageCache
+
+        cache = StageCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024**2)
+
+    # Trace the pipeline steps only when asked
+    tracer = StageTracer(profile_stage=args.profile_stage) if args.trace or args.profile_stage else None
+    with tracer.activate() if tracer else nullcontext():
+        try:
+            run(args, cache)
+        finally:
+            if tracer and args.trace:
+                tracer.save(args.trace)
+
+
+def run(args, cache=None):
+    """Preprocess the trips with the options parsed in main"""
+
+    if args.flows:
+        flows = aggregate_flows(args.trips, granularity=args.granularity, resolution=args.resolution, chunksize=args.chunksize)
+        flows.save(f'flows_{args.granularity}' + ('_hourly' if args.resolution == 'hourly' else ''))
+        return
+
+    if args.incremental and args.resolution == 'hourly':
+        raise ValueError('--incremental only supports the daily resolution')
+    if args.incremental and args.workers is not None:
+        raise ValueError('--incremental reads a file of new trips, it does not support --workers')
+
+    # Only the trips after the last preprocessed day are aggregated in incremental runs
+    state = load_state() if args.incremental else None
+    if state is not None:
+        if state['granularity'] != args.granularity:
+            raise ValueError(f"the saved state was built with granularity {state['granularity']!r}, got {args.granularity!r}")
+        if 'outliers' not in state or 'train_end' not in state:
+            raise ValueError(f'the saved state has no fitted outlier bounds, run a full preprocessing to rebuild {STATE_PATH}')
+
+    if args.workers is not None:
+        paths = sorted(glob.glob(args.trips))
+        if not paths:
+            raise FileNotFoundError(f'no trips files match {args.trips}')
+        trips_dt_quadrant = aggregate_trips_partitioned(paths, workers=args.workers or None,
+                                                        chunksize=args.chunksize or 500_000, granularity=args.granularity,
+                                                        compact=args.compact, resolution=args.resolution)
+    elif args.chunksize:
+        trips_dt_quadrant = aggregate_trips_chunked(args.trips, chunksize=args.chunksize, granularity=args.granularity, compact=args.compact,
+                                                    resolution=args.resolution, after=state and state['last_date'])
+    else:
+        trips = load_trips(args.trips, compact=args.compact)
+        if state is not None:
+            trips = select_new_trips(trips, state['last_date']).reset_index(drop=True)
+        trips_dt_quadrant = aggregate_trips(trips, granularity=args.granularity, cache=cache, compact=args.compact, resolution=args.resolution) if len(trips) else None
+
+    if trips_dt_quadrant is None:
+        print(f"no trips after {state['last_date']}")
+        return
+
+    dates = pd.to_datetime(trips_dt_quadrant['date_formatted'])
+    weather, ar_holidays = load_weather_holidays(years=range(dates.min().year, dates.max().year + 1), compact=args.compact)
+
+    if args.resolution == 'hourly':
+        hourly_weather = load_hourly_weather(args.hourly_weather) if args.hourly_weather else None
+        trips_by_hour = add_features(trips_dt_quadrant, weather, ar_holidays, cache=cache, resolution='hourly', hourly_weather=hourly_weather,
+                                     fit_end=args.train_end)
+        write_data(trips_by_hour, output_format=args.format, name='trips_preprocessed_hourly')
+        return
+
+    if state is not None:
+        new_rows, state = preprocess_incremental(trips_dt_quadrant, weather, ar_holidays, state)
+        if new_rows is not None:
+            write_data(new_rows, output_format=args.format, append=True)
+            save_state(state)
+        return
+
+    # Save the state needed to add new days later with --incremental
+    state = build_incremental_state(trips_dt_quadrant, weather, granularity=args.granularity)
+
+    outliers = ReplaceOutliersByDayOfWeek()
+    trips_dt_wht_hol_transformed = add_features(trips_dt_quadrant, weather, ar_holidays, cache=cache, outliers=outliers, fit_end=args.train_end)
+    write_data(trips_dt_wht_hol_transformed, output_format=args.format)
+
+    # new days are scored with the fitted outlier bounds
+    state['outliers'] = outliers
+    state['train_end'] = args.train_end
+    save_state(state)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,190 @@
+import argparse
+import json
+import pickle
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import scipy.sparse as sp
+
+from fit import FIT_COLUMNS, load_data
+
+
+class FeatureTable:
+    """Model inputs for every (date, quadrant) of the preprocessed dataset, transformed once when the server starts.
+
+    The fitted preprocessing of the pipeline (imputers and one-hot encoding) is applied to the whole table,
+    so requests only look up rows and run the booster on them.
+    """
+
+    def __init__(self, pipeline, trips_preprocessed):
+        features = pipeline['preprocessor'].transform(trips_preprocessed)
+        self.features = features.tocsr() if sp.issparse(features) else np.ascontiguousarray(features)
+        self.rows = {
+            (date, quadrant): i
+            for i, (date, quadrant) in enumerate(zip(trips_preprocessed['date_formatted'], trips_preprocessed['quadrant']))
+        }
+        self.booster = pipeline['xgb'].get_booster()
+
+    def lookup(self, keys):
+        """Row of each (date, quadrant) key, raises KeyError for keys not in the table"""
+        return [self.rows[key] for key in keys]
+
+    def predict(self, rows):
+        return self.booster.inplace_predict(self.features[rows])
+
+
+class BatchPredictor:
+    """Group the requests that arrive within window_ms in a single predict call.
+
+    If the predict call of a batch fails, its error is raised in every request of the batch and the thread keeps
+    serving the next batches. predict raises TimeoutError when no prediction arrives within timeout_s.
+    """
+
+    def __init__(self, table, window_ms=1.0, max_batch=1024, timeout_s=10.0):
+        self.table = table
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout_s
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def predict(self, rows):
+        request = {'rows': rows, 'done': threading.Event()}
+        self.requests.put(request)
+        if not request['done'].wait(self.timeout):
+            raise TimeoutError(f'no prediction after {self.timeout} s')
+        if 'error' in request:
+            raise request['error']
+        return request['prediction']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_rows = len(batch[0]['rows'])
+            deadline = time.perf_counter() + self.window
+
+            # wait for more requests until the window closes or the batch is full
+            while n_rows < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_rows += len(request['rows'])
+
+            rows = [row for request in batch for row in request['rows']]
+            try:
+                prediction = self.table.predict(rows)
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+                    request['done'].set()
+                continue
+
+            start = 0
+            for request in batch:
+                request['prediction'] = prediction[start:start + len(request['rows'])]
+                request['done'].set()
+                start += len(request['rows'])
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """HTTP endpoints:
+    - GET /predict?date=2022-11-01&quadrant=NE: forecast for one date and quadrant
+    - POST /predict with a JSON list of {"date": ..., "quadrant": ...}: forecasts for a batch
+    - GET /health
+    """
+
+    predictor = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif url.path == '/predict':
+            params = parse_qs(url.query)
+            if 'date' not in params or 'quadrant' not in params:
+                self.send_json(400, {'error': 'date and quadrant are required'})
+                return
+            self.send_predictions([{'date': params['date'][0], 'quadrant': params['quadrant'][0]}], single=True)
+        else:
+            self.send_json(404, {'error': f'unknown path {url.path}'})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            keys = [{'date': item['date'], 'quadrant': item['quadrant']} for item in json.loads(body)]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'expected a JSON list of {"date": ..., "quadrant": ...}'})
+            return
+        self.send_predictions(keys, single=False)
+
+    def send_predictions(self, keys, single):
+        try:
+            rows = self.predictor.table.lookup([(key['date'], key['quadrant']) for key in keys])
+        except KeyError as e:
+            self.send_json(404, {'error': f'no features for {e.args[0]}'})
+            return
+
+        try:
+            prediction = self.predictor.predict(rows) if rows else []
+        except TimeoutError as e:
+            self.send_json(503, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': f'prediction failed: {e}'})
+            return
+        results = [dict(key, trips=float(trips)) for key, trips in zip(keys, prediction)]
+        self.send_json(200, results[0] if single else results)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the request log quiet, it costs more than the prediction
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve forecasts by date and quadrant from a saved XGBoost pipeline')
+    parser.add_argument('--model', default='models/xgboost_model.pkl', help='pickled XGBoost pipeline')
+    parser.add_argument('--data', default='trips_preprocessed',
+                        help='preprocessed dataset with the features, a CSV file or a Parquet dataset directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--batch-window-ms', type=float, default=1.0,
+                        help='time to wait for more requests to predict them together')
+    parser.add_argument('--timeout-s', type=float, default=10.0,
+                        help='time a request waits for its prediction before answering 503')
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as file:
+        pipeline = pickle.load(file)
+    # features are looked up by date and quadrant, models trained on trips by hour also need the hour
+    if any('hour' in columns for _, _, columns in pipeline['preprocessor'].transformers_):
+        parser.error(f'{args.model} was trained with --resolution hourly, only daily models can be served')
+    table = FeatureTable(pipeline, load_data(args.data, columns=FIT_COLUMNS))
+    PredictionHandler.predictor = BatchPredictor(table, window_ms=args.batch_window_ms, timeout_s=args.timeout_s)
+    print(f'loaded {len(table.rows)} rows of features')
+
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    print(f'serving on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
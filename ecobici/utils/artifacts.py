@@ -0,0 +1,131 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Version of the artifact layout, bumped when the files or the manifest change
+ARTIFACT_VERSION = 1
+
+
+def save_xgboost_artifact(pipeline, path, X=None, n_check=1000):
+    """Save a fitted XGBoost pipeline (ColumnTransformer + XGBRegressor) as an artifact directory:
+    - booster.ubj: the booster in XGBoost's native binary format
+    - preprocessing.npz: the fitted imputer statistics and one-hot categories
+    - manifest.json: artifact and library versions, the input columns of each preprocessing step and whether the
+      ColumnTransformer output is sparse (XGBoost reads the zeros not stored in a sparse matrix as missing values)
+
+    The artifact is loaded with load_xgboost_artifact without unpickling sklearn objects.
+    If X is given, the artifact is loaded back and its predictions on the first n_check rows are checked against the pipeline.
+    """
+    import sklearn
+    import xgboost as xgb
+
+    os.makedirs(path, exist_ok=True)
+    pipeline['xgb'].get_booster().save_model(os.path.join(path, 'booster.ubj'))
+
+    steps = []
+    arrays = {}
+    for name, transformer, columns in pipeline['preprocessor'].transformers_:
+        if name == 'remainder':
+            continue
+        step = {'name': name, 'columns': list(columns), 'kind': type(transformer).__name__}
+        if step['kind'] == 'SimpleImputer':
+            arrays[f'{name}_statistics'] = transformer.statistics_.astype('float64')
+        elif step['kind'] == 'OneHotEncoder':
+            step['handle_unknown'] = transformer.handle_unknown
+            for i, categories in enumerate(transformer.categories_):
+                arrays[f'{name}_categories_{i}'] = np.asarray(categories).astype(str)
+        else:
+            raise ValueError(f'unsupported preprocessing step {name}: {step["kind"]}')
+        steps.append(step)
+    np.savez(os.path.join(path, 'preprocessing.npz'), **arrays)
+
+    manifest = {
+        'artifact_version': ARTIFACT_VERSION,
+        'xgboost_version': xgb.__version__,
+        'sklearn_version': sklearn.__version__,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sparse_output': bool(pipeline['preprocessor'].sparse_output_),
+        'steps': steps,
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print(f'Artifact saved to {path}')
+
+    if X is not None:
+        check_artifact(pipeline, path, X.iloc[:n_check])
+
+
+def check_artifact(pipeline, path, X):
+    """Raise if the artifact in path does not predict like the pipeline on X"""
+
+    expected = pipeline.predict(X)
+    predicted = load_xgboost_artifact(path).predict(X)
+    if not np.allclose(predicted, expected, rtol=1e-5, atol=1e-4):
+        raise ValueError(f'the artifact in {path} predicts differently from the pipeline, '
+                         f'max difference {np.abs(predicted - expected).max()}')
+
+def load_xgboost_artifact(path):
+    """Load an artifact saved with save_xgboost_artifact"""
+    return XGBoostArtifact(path)
+
+
+class XGBoostArtifact:
+    """XGBoost model loaded from an artifact directory, predicts like the original pipeline.
+
+    Only numpy, pandas and xgboost are needed: the preprocessing is applied with the saved arrays.
+    """
+
+    def __init__(self, path):
+        import xgboost as xgb
+
+        with open(os.path.join(path, 'manifest.json')) as file:
+            self.manifest = json.load(file)
+        if self.manifest['artifact_version'] != ARTIFACT_VERSION:
+            raise ValueError(f"artifact version {self.manifest['artifact_version']} is not supported, expected {ARTIFACT_VERSION}")
+
+        with np.load(os.path.join(path, 'preprocessing.npz')) as arrays:
+            self.arrays = {name: arrays[name] for name in arrays.files}
+
+        self.booster = xgb.Booster()
+        self.booster.load_model(os.path.join(path, 'booster.ubj'))
+
+    def transform(self, X):
+        """Apply the saved preprocessing steps, in the order of the ColumnTransformer.
+        Like the ColumnTransformer, the output is a CSR matrix when it was sparse in training: zeros of the dense
+        steps are not stored, and XGBoost reads them as missing values."""
+        from scipy import sparse
+
+        sparse_output = self.manifest.get('sparse_output', False)
+        blocks = []
+        for step in self.manifest['steps']:
+            name, columns = step['name'], step['columns']
+            if step['kind'] == 'SimpleImputer':
+                statistics = self.arrays[f'{name}_statistics']
+                values = X[columns].to_numpy(dtype='float64')
+                values = np.where(np.isnan(values), statistics, values)
+                # the imputer drops the columns that had no values in training
+                blocks.append(values[:, ~np.isnan(statistics)])
+            else:
+                for i, column in enumerate(columns):
+                    categories = self.arrays[f'{name}_categories_{i}']
+                    codes = pd.Categorical(X[column].astype(str), categories=categories).codes
+                    if step['handle_unknown'] == 'error' and (codes < 0).any():
+                        unknown = X[column][codes < 0].unique()
+                        raise ValueError(f'found unknown categories {list(unknown)} in column {column}')
+                    known = codes >= 0
+                    if sparse_output:
+                        one_hot = sparse.csr_matrix((np.ones(known.sum()), (np.flatnonzero(known), codes[known])),
+                                                    shape=(len(X), len(categories)))
+                    else:
+                        one_hot = np.zeros((len(X), len(categories)))
+                        one_hot[np.flatnonzero(known), codes[known]] = 1
+                    blocks.append(one_hot)
+        if sparse_output:
+            return sparse.hstack(blocks).tocsr()
+        return np.hstack(blocks)
+
+    def predict(self, X):
+        return self.booster.inplace_predict(self.transform(X))
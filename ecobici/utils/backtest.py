@@ -0,0 +1,84 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pmdarima import ARIMA, auto_arima
+
+
+def walk_forward_origins(dates, start, step_days=7):
+    """Forecast origins every step_days from start until the last date"""
+
+    dates = pd.to_datetime(pd.Series(dates))
+    return pd.date_range(pd.Timestamp(start), dates.max(), freq=f'{step_days}D')
+
+
+def search_order(series, y_train, X_train):
+    """Run the full stepwise auto-arima search for a series and return its orders"""
+
+    model = auto_arima(y_train, X=X_train, suppress_warnings=True, error_action='ignore')
+    return series, model.order, model.seasonal_order
+
+
+def forecast_fold(series, fold, y_train, X_train, X_test, order, seasonal_order):
+    """Fit an ARIMA with a known order on the training window and forecast the test window with its exogenous features"""
+
+    model = ARIMA(order=order, seasonal_order=seasonal_order, suppress_warnings=True)
+    model.fit(y_train, X=X_train)
+    y_pred = model.predict(n_periods=len(X_test), X=X_test)
+    return series, fold, np.asarray(y_pred)
+
+
+def backtest_autoarima(ts, features, target='trips', start='2022-11-01', step_days=7, n_jobs=None):
+    """Walk-forward backtest of one auto-arima model per quadrant.
+
+    From start, the models are refit every step_days on all the days before the origin, and forecast the next
+    step_days passing the exogenous features of those days. The stepwise order search only runs on the first fold of
+    each quadrant, later folds are warm-started with the order found there. Quadrants and folds run in a process pool
+    of n_jobs workers (all cores by default).
+
+    Returns a dataframe with one row per forecasted day: quadrant, fold, date, horizon (days ahead), trips and prediction.
+    """
+
+    ts = ts.assign(date=pd.to_datetime(ts['date_formatted'])).sort_values(by='date')
+    origins = walk_forward_origins(ts['date'], start, step_days)
+
+    # training and test windows of each quadrant and fold, passed to the models as arrays
+    folds = []
+    for q, series in ts.groupby('quadrant'):
+        for fold, origin in enumerate(origins):
+            train = series[series['date'] < origin]
+            test = series[(series['date'] >= origin) & (series['date'] < origin + pd.Timedelta(days=step_days))]
+            if len(train) and len(test):
+                folds.append((q, fold, train, test))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # search the order once per quadrant, on its first fold
+        first_folds = {}
+        for q, fold, train, test in folds:
+            first_folds.setdefault(q, (train, test))
+        searches = [
+            executor.submit(search_order, q, train[target].to_numpy(), train[features].to_numpy())
+            for q, (train, test) in first_folds.items()
+        ]
+        orders = {q: (order, seasonal_order) for q, order, seasonal_order in (f.result() for f in searches)}
+        print('searched arima orders')
+
+        # refit every fold with the order of its quadrant
+        forecasts = [
+            executor.submit(forecast_fold, q, fold, train[target].to_numpy(), train[features].to_numpy(), test[features].to_numpy(), *orders[q])
+            for q, fold, train, test in folds
+        ]
+        predictions = {(q, fold): y_pred for q, fold, y_pred in (f.result() for f in forecasts)}
+        print(f'forecasted {len(folds)} folds')
+
+    results = []
+    for q, fold, train, test in folds:
+        results.append(pd.DataFrame({
+            'quadrant': q,
+            'fold': fold,
+            'date': test['date'].to_numpy(),
+            'horizon': (test['date'] - origins[fold]).dt.days.to_numpy() + 1,
+            'trips': test[target].to_numpy(),
+            'prediction': predictions[(q, fold)],
+        }))
+    return pd.concat(results, ignore_index=True)
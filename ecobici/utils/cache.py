@@ -0,0 +1,114 @@
+import hashlib
+import inspect
+import os
+import sys
+
+import pandas as pd
+
+# Directory of the repository modules, the source of the transformer classes defined under it is part of their key
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StageCache:
+    """On-disk cache of the output of each pipeline step.
+
+    Outputs are content addressed: the key of a step is a hash of its input and of the step itself
+    (transformer class, its source code and its parameters). The input of the first step is hashed from its data,
+    and the input of every next step is identified by the key of the step that produced it, so a change in one step
+    only recomputes that step and the ones after it.
+
+    Entries are pickled dataframes in path. When the cache grows over max_bytes, the least recently used entries
+    are deleted.
+    """
+
+    def __init__(self, path='.stage_cache', max_bytes=2 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def run(self, pipeline, X, method='fit_transform', input_key=None):
+        """Run each step of the pipeline, loading its output from the cache when it was already computed.
+        Returns the output of the pipeline and its key, which can be passed as input_key to the next pipeline."""
+
+        keys = []
+        key = input_key or hash_data(X)
+        for name, step in pipeline.steps:
+            key = hash_values(key, step_signature(step))
+            keys.append(key)
+
+        # only the output of the last cached step is loaded, the steps after it are run
+        start = 0
+        for i in reversed(range(len(keys))):
+            entry = self.entry(keys[i])
+            if os.path.exists(entry):
+                X = pd.read_pickle(entry)
+                # mark the entry as recently used
+                os.utime(entry)
+                print(f'loaded {pipeline.steps[i][0]} from cache')
+                start = i + 1
+                break
+
+        for (name, step), key in zip(pipeline.steps[start:], keys[start:]):
+            X = getattr(step, method)(X)
+            X.to_pickle(self.entry(key))
+            self.evict()
+
+        return X, key
+
+    def entry(self, key):
+        return os.path.join(self.path, f'{key}.pkl')
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes"""
+
+        entries = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.pkl')]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in entries)
+
+        # the newest entry is kept even if it is bigger than max_bytes
+        for entry in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+
+def hash_values(*values):
+    return hashlib.sha256('|'.join(values).encode()).hexdigest()
+
+
+def hash_data(df):
+    """Hash the content of a dataframe: values, index, column names and dtypes"""
+
+    digest = hashlib.sha256()
+    digest.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def step_signature(step):
+    """Identify a transformer by its class, its source code and its parameters.
+    The source includes the base classes of the repository, so a change in a shared base class changes the key of
+    its subclasses. Library classes (e.g. sklearn's) are not hashed."""
+
+    cls = type(step)
+    sources = []
+    for klass in cls.__mro__:
+        module_path = getattr(sys.modules.get(klass.__module__), '__file__', None)
+        if module_path is None or not os.path.abspath(module_path).startswith(REPO_PATH + os.sep):
+            continue
+        try:
+            sources.append(inspect.getsource(klass))
+        except (OSError, TypeError):
+            pass
+
+    # like sklearn, the parameters are the arguments of __init__, which also works for transformers that are not estimators
+    params = []
+    for param in inspect.signature(cls.__init__).parameters.values():
+        if param.name == 'self' or param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        value = getattr(step, param.name, None)
+        value = hash_data(value) if isinstance(value, pd.DataFrame) else repr(value)
+        params.append(f'{param.name}={value}')
+
+    return hash_values(f'{cls.__module__}.{cls.__qualname__}', *sources, *params)
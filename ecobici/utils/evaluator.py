@@ -1,6 +1,13 @@
-import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+# Keys of each prediction in the long format prediction tables
+KEY_COLUMNS = ['model', 'fold', 'group', 'horizon']
+METRICS = ['n', 'rmse', 'mae', 'bias', 'wape', 'smape', 'mape']
+
 
 def plot_forecasted_series(y_train, forecast, y_true) :
+    import matplotlib.pyplot as plt
 
     # Plot the actual values
     plt.plot(y_train, label='Actual')
@@ -10,4 +17,78 @@ def plot_forecasted_series(y_train, forecast, y_true) :
     plt.plot(range(len(y_train), len(y_train) + len(y_true)), y_true, label='Test Data', color='green')
 
     plt.legend()
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def prediction_table(y_pred, y, model, group=None, fold=0, horizon=1, **quantile_predictions):
+    """Predictions in long format, one row per prediction with its keys (model, fold, group, horizon),
+    the actual value and the prediction. Keys can be a single value or an array per row, and quantile predictions
+    are passed as columns, e.g. q10=array"""
+
+    keys = {key: np.asarray(value) if np.ndim(value) else value for key, value in zip(KEY_COLUMNS, [model, fold, group, horizon])}
+    return pd.DataFrame({
+        **keys,
+        'actual': np.asarray(y, dtype='float64'),
+        'prediction': np.asarray(y_pred, dtype='float64'),
+        **{name: np.asarray(values, dtype='float64') for name, values in quantile_predictions.items()},
+    })
+
+
+def compute_metrics(predictions, by=KEY_COLUMNS, quantiles=None):
+    """Compute the metrics of each group of predictions in one grouped pass, from a long format table with the actual
+    values and the predictions (see prediction_table):
+    - n: number of predictions
+    - rmse, mae and bias (mean of prediction - actual)
+    - wape: sum of |error| / sum of |actual|, which stays defined when some actual values are 0
+    - smape: mean of 2 |error| / (|actual| + |prediction|), 0 when both are 0
+    - mape: mean of |error| / |actual| over the predictions with actual values other than 0 only. Series with days or
+      hours without trips would otherwise divide by 0 (sklearn divides by the float epsilon, giving values like 1e14)
+    - quantile_loss_<column>: pinball loss of each quantile prediction in quantiles, e.g. {'q10': 0.1, 'q90': 0.9}
+
+    by are the key columns to group by, all the predictions are aggregated when empty.
+    Returns one row per group with the keys as columns.
+    """
+
+    actual = predictions['actual'].to_numpy(dtype='float64')
+    prediction = predictions['prediction'].to_numpy(dtype='float64')
+    error = prediction - actual
+    nonzero = actual != 0
+    scale = np.abs(actual) + np.abs(prediction)
+
+    # errors of each row, summed by group
+    row_errors = {
+        'n': np.ones(len(actual)),
+        'squared_error': error ** 2,
+        'absolute_error': np.abs(error),
+        'error': error,
+        'absolute_actual': np.abs(actual),
+        'symmetric_error': np.divide(2 * np.abs(error), scale, out=np.zeros(len(actual)), where=scale > 0),
+        'nonzero': nonzero.astype(float),
+        'percentage_error': np.divide(np.abs(error), np.abs(actual), out=np.zeros(len(actual)), where=nonzero),
+    }
+    for column, quantile in (quantiles or {}).items():
+        residual = actual - predictions[column].to_numpy(dtype='float64')
+        row_errors[f'quantile_loss_{column}'] = np.maximum(quantile * residual, (quantile - 1) * residual)
+
+    by = list(by)
+    errors = pd.DataFrame(row_errors, index=predictions.index)
+    if by:
+        sums = errors.groupby([predictions[key] for key in by], sort=True, observed=True).sum()
+    else:
+        sums = errors.sum().to_frame().T
+
+    n = sums['n']
+    metrics = pd.DataFrame({
+        'n': n.astype(int),
+        'rmse': np.sqrt(sums['squared_error'] / n),
+        'mae': sums['absolute_error'] / n,
+        'bias': sums['error'] / n,
+        # NaN for groups whose actual values are all 0
+        'wape': sums['absolute_error'] / sums['absolute_actual'].where(sums['absolute_actual'] > 0),
+        'smape': sums['symmetric_error'] / n,
+        'mape': sums['percentage_error'] / sums['nonzero'].where(sums['nonzero'] > 0),
+    }, index=sums.index)
+    for column in quantiles or {}:
+        metrics[f'quantile_loss_{column}'] = sums[f'quantile_loss_{column}'] / n
+
+    return metrics.reset_index() if by else metrics.reset_index(drop=True)
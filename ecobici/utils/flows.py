@@ -0,0 +1,166 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# numpy units of the flow periods
+PERIOD_UNITS = {'daily': 'D', 'hourly': 'h'}
+
+
+class FlowMatrices:
+    """Origin - destination trip counts between zones (stations, quadrants or comunas), one sparse matrix per period.
+
+    The matrices of all periods are stacked in a single CSR array of n_periods * n_zones rows: row
+    period * n_zones + origin holds the trips from origin to each destination in that period. Periods are
+    consecutive days or hours starting at start, so the rows of a period or of a range of periods are a contiguous
+    slice of the arrays, and queries on a range only read that slice (the arrays can be memory mapped).
+    """
+
+    def __init__(self, data, indices, indptr, zones, start, unit='D'):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.zones = pd.Index(zones)
+        self.start = np.datetime64(start, unit)
+        self.unit = unit
+
+    @property
+    def n_zones(self):
+        return len(self.zones)
+
+    @property
+    def n_periods(self):
+        return (len(self.indptr) - 1) // self.n_zones
+
+    @property
+    def periods(self):
+        return pd.DatetimeIndex(self.start + np.arange(self.n_periods))
+
+    def period_index(self, period):
+        """Position of a period given as a date or datetime"""
+
+        position = int((np.datetime64(pd.Timestamp(period), self.unit) - self.start).astype(int))
+        if not 0 <= position < self.n_periods:
+            raise KeyError(f'{period} is out of the flow periods, {self.periods[0]} to {self.periods[-1]}')
+        return position
+
+    def period_range(self, start=None, end=None):
+        """Positions of the first period and after the last one, between start and end (both included).
+        The selection is empty when no stored period is in the range."""
+
+        start = self.periods[0] if start is None else max(pd.Timestamp(start), self.periods[0])
+        end = self.periods[-1] if end is None else min(pd.Timestamp(end), self.periods[-1])
+        if start > end:
+            return 0, 0
+        return self.period_index(start), self.period_index(end) + 1
+
+    def rows(self, first, stop):
+        """CSR arrays of the rows of the periods first to stop, with indptr starting at 0"""
+
+        indptr = self.indptr[first * self.n_zones:stop * self.n_zones + 1]
+        begin, end = indptr[0], indptr[-1]
+        return np.asarray(self.data[begin:end]), np.asarray(self.indices[begin:end]), np.asarray(indptr) - begin
+
+    def matrix(self, period):
+        """Zone x zone sparse matrix of a period, rows are origins and columns destinations"""
+
+        position = self.period_index(period)
+        data, indices, indptr = self.rows(position, position + 1)
+        return sparse.csr_matrix((data, indices, indptr), shape=(self.n_zones, self.n_zones))
+
+    def total(self, start=None, end=None):
+        """Zone x zone sparse matrix with the trips of all periods between start and end"""
+
+        first, stop = self.period_range(start, end)
+        data, indices, indptr = self.rows(first, stop)
+        origins = np.repeat(np.arange(len(indptr) - 1) % self.n_zones, np.diff(indptr))
+        # duplicated (origin, destination) pairs are summed
+        return sparse.csr_matrix((data, (origins, indices)), shape=(self.n_zones, self.n_zones))
+
+    def outflow(self, start=None, end=None):
+        """Trips leaving each zone, as an array of periods x zones"""
+
+        first, stop = self.period_range(start, end)
+        data, _, indptr = self.rows(first, stop)
+        # row sums from the cumulative sum of the values
+        cumulative = np.concatenate([[0], np.cumsum(data, dtype=np.int64)])
+        return (cumulative[indptr[1:]] - cumulative[indptr[:-1]]).reshape(stop - first, self.n_zones)
+
+    def inflow(self, start=None, end=None):
+        """Trips arriving at each zone, as an array of periods x zones"""
+
+        first, stop = self.period_range(start, end)
+        data, indices, indptr = self.rows(first, stop)
+        periods = np.repeat(np.arange(len(indptr) - 1) // self.n_zones, np.diff(indptr))
+        counts = np.bincount(periods * self.n_zones + indices, weights=data, minlength=(stop - first) * self.n_zones)
+        return counts.astype(np.int64).reshape(stop - first, self.n_zones)
+
+    def net_flows(self, start=None, end=None):
+        """Outflow, inflow and net inflow (inflow - outflow) of each zone and period, one row per period and zone"""
+
+        first, stop = self.period_range(start, end)
+        outflow = self.outflow(start, end).ravel()
+        inflow = self.inflow(start, end).ravel()
+        return pd.DataFrame({
+            'period': np.repeat(self.periods[first:stop], self.n_zones),
+            'zone': np.tile(self.zones, stop - first),
+            'outflow': outflow,
+            'inflow': inflow,
+            'net_inflow': inflow - outflow,
+        })
+
+    def save(self, path):
+        """Save the CSR arrays as .npy files in the directory path, with the zones and periods in meta.json"""
+
+        os.makedirs(path, exist_ok=True)
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(path, f'{name}.npy'), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'zones': [str(zone) for zone in self.zones], 'start': str(self.start), 'unit': self.unit}, file)
+        print(f'flows saved in {path}')
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load flows saved with save. With mmap=True the arrays are memory mapped and only the queried periods are read"""
+
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        arrays = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None) for name in ['data', 'indices', 'indptr']]
+        return cls(*arrays, zones=meta['zones'], start=meta['start'], unit=meta['unit'])
+
+
+def count_station_flows(periods, origins, destinations):
+    """Count trips by period, origin and destination station, as a series indexed by the three of them"""
+    return pd.DataFrame({'period': periods, 'origin': origins, 'destination': destinations}).value_counts(sort=False)
+
+
+def build_flow_matrices(counts, station_zones, zones, unit='D'):
+    """Stack the counts of count_station_flows into FlowMatrices.
+
+    - counts: trips by (period, origin station, destination station), with periods as integers in unit since the epoch
+    - station_zones: zone position of each station, indexed like the station levels of counts, -1 for stations
+      without zone, whose trips are not counted
+    - zones: labels of the zones
+    """
+
+    origin = station_zones[counts.index.get_level_values('origin').to_numpy()]
+    destination = station_zones[counts.index.get_level_values('destination').to_numpy()]
+    located = (origin >= 0) & (destination >= 0)
+    counts, origin, destination = counts[located], origin[located], destination[located]
+    period = counts.index.get_level_values('period').to_numpy()
+
+    n_zones = len(zones)
+    first = period.min()
+    n_periods = period.max() - first + 1
+
+    # stations of the same zone are merged: sum the counts of each (period, origin zone, destination zone)
+    keys = ((period - first) * n_zones + origin) * n_zones + destination
+    keys, inverse = np.unique(keys, return_inverse=True)
+    data = np.bincount(inverse, weights=counts.to_numpy()).astype(np.int32)
+
+    # keys are sorted by row and then by column, as CSR stores them
+    rows = keys // n_zones
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_periods * n_zones))])
+    return FlowMatrices(data, (keys % n_zones).astype(np.int32), indptr, zones, np.datetime64(int(first), unit), unit)
@@ -0,0 +1,229 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.impute import SimpleImputer
+
+from utils.preprocessor import RollingAveragesTransformer
+
+# Features of RollingAveragesTransformer, rebuilt from the forecasts at each step
+ROLLING_FEATURES = ['trips_last_day', 'avg_trips_last_week', 'avg_trips_last_month', 'trips_same_day_last_week']
+
+
+class RingBuffers:
+    """Last size values of many series, in a (series, size) array where each series is written in circular order.
+    Positions that were not written yet are NaN."""
+
+    def __init__(self, n_series, size):
+        self.values = np.full((n_series, size), np.nan)
+        self.head = np.zeros(n_series, dtype=int)
+
+    def last(self, rows, steps):
+        """Value written steps writes ago in each of rows (1 is the last one)"""
+        return self.values[rows, (self.head[rows] - steps) % self.values.shape[1]]
+
+    def push(self, rows, values):
+        self.values[rows, self.head[rows]] = values
+        self.head[rows] = (self.head[rows] + 1) % self.values.shape[1]
+
+    def grow(self, n_series):
+        """Add empty series up to n_series"""
+        added = n_series - len(self.head)
+        self.values = np.vstack([self.values, np.full((added, self.values.shape[1]), np.nan)])
+        self.head = np.r_[self.head, np.zeros(added, dtype=int)]
+
+
+class RollingState:
+    """Rolling features of RollingAveragesTransformer for the next day of every series, updated in O(1) per series and day.
+
+    Series are keyed by group and is_weekend like in the transformer: the last values of each series are kept in
+    ring buffers with the sums and counts of the week and month windows, and the values of each group and weekday in
+    other ring buffers for the same day lag.
+    """
+
+    def __init__(self, n_groups, rolling):
+        self.rolling = rolling
+        size = max(rolling.weekday_month_window, rolling.weekend_month_window, rolling.weekday_week_window, rolling.weekend_week_window)
+        self.series = RingBuffers(2 * n_groups, size)
+        self.same_day = RingBuffers(7 * n_groups, max(rolling.weekday_same_day_lag, rolling.weekend_same_day_lag))
+        self.sums = {window: np.zeros(2 * n_groups) for window in ['week', 'month']}
+        self.counts = {window: np.zeros(2 * n_groups) for window in ['week', 'month']}
+
+    def grow(self, n_groups):
+        self.series.grow(2 * n_groups)
+        self.same_day.grow(7 * n_groups)
+        for window in ['week', 'month']:
+            self.sums[window] = np.r_[self.sums[window], np.zeros(2 * n_groups - len(self.sums[window]))]
+            self.counts[window] = np.r_[self.counts[window], np.zeros(2 * n_groups - len(self.counts[window]))]
+
+    def windows(self, is_weekend):
+        rolling = self.rolling
+        if is_weekend:
+            return {'week': rolling.weekend_week_window, 'month': rolling.weekend_month_window}, rolling.weekend_same_day_lag
+        return {'week': rolling.weekday_week_window, 'month': rolling.weekday_month_window}, rolling.weekday_same_day_lag
+
+    def features(self, groups, weekday, is_weekend):
+        """Rolling features of the groups for a day, from the values pushed before it"""
+
+        series = 2 * groups + is_weekend
+        windows, lag = self.windows(is_weekend)
+        features = {'trips_last_day': self.series.last(series, 1)}
+        for window in windows:
+            counts = self.counts[window][series]
+            features[f'avg_trips_last_{window}'] = np.divide(self.sums[window][series], counts,
+                                                             out=np.full(len(series), np.nan), where=counts > 0)
+        features['trips_same_day_last_week'] = self.same_day.last(7 * groups + weekday, lag)
+        return features
+
+    def push(self, groups, weekday, is_weekend, values):
+        """Add the trips of the groups for a day"""
+
+        series = 2 * groups + is_weekend
+        windows, _ = self.windows(is_weekend)
+        valid = ~np.isnan(values)
+        for window, size in windows.items():
+            # the value size days back leaves the window
+            leaving = self.series.last(series, size)
+            leaving_valid = ~np.isnan(leaving)
+            self.sums[window][series] += np.where(valid, values, 0) - np.where(leaving_valid, leaving, 0)
+            self.counts[window][series] += valid.astype(int) - leaving_valid
+        self.series.push(series, values)
+        self.same_day.push(7 * groups + weekday, values)
+
+
+def imputed_columns(preprocessor, columns):
+    """Position in the output of a fitted ColumnTransformer of each of columns that goes through a SimpleImputer,
+    with the value that replaces it when missing"""
+
+    positions = {}
+    for name, transformer, transformer_columns in preprocessor.transformers_:
+        if not isinstance(transformer, SimpleImputer):
+            continue
+        # the imputer drops the columns that had no values in fit
+        kept = ~pd.isna(transformer.statistics_)
+        start = preprocessor.output_indices_[name].start
+        for i, column in enumerate(transformer_columns):
+            if column in columns and kept[i]:
+                positions[column] = (start + int(kept[:i].sum()), float(transformer.statistics_[i]))
+    return positions
+
+
+class BoosterInputs:
+    """Booster inputs of the rows of future for a fitted XGBoost pipeline (with 'preprocessor' and 'xgb' steps).
+
+    The preprocessor is applied once to future. For each day, the rolling features are written in their columns,
+    imputed like the preprocessor does, and the booster predicts the rows with inplace_predict, like serve.FeatureTable.
+    Sparse outputs keep the zeros of the rolling features as missing values, like the ColumnTransformer.
+    """
+
+    def __init__(self, pipeline, future):
+        positions = imputed_columns(pipeline['preprocessor'], ROLLING_FEATURES)
+        self.columns = sorted(positions, key=lambda column: positions[column][0])
+        self.positions = np.array([positions[column][0] for column in self.columns])
+        self.fill = np.array([positions[column][1] for column in self.columns])
+
+        features = pipeline['preprocessor'].transform(future)
+        self.sparse = sp.issparse(features)
+        self.features = features.tocsr() if self.sparse else np.asarray(features, dtype='float64')
+        self.booster = pipeline['xgb'].get_booster()
+
+    @staticmethod
+    def supports(model):
+        """Whether model is a fitted XGBoost pipeline whose rolling features are contiguous output columns"""
+
+        steps = getattr(model, 'named_steps', {})
+        if 'preprocessor' not in steps or 'xgb' not in steps:
+            return False
+        positions = sorted(position for position, _ in imputed_columns(steps['preprocessor'], ROLLING_FEATURES).values())
+        return len(positions) > 0 and positions == list(range(positions[0], positions[0] + len(positions)))
+
+    def predict(self, rows, day_features):
+        values = np.column_stack([day_features[column] for column in self.columns])
+        values = np.where(np.isnan(values), self.fill, values)
+
+        if self.sparse:
+            first, stop = self.positions[0], self.positions[-1] + 1
+            day = self.features[rows]
+            X = sp.hstack([day[:, :first], sp.csr_matrix(values), day[:, stop:]], format='csr')
+        else:
+            X = self.features[rows]
+            X[:, self.positions] = values
+        return self.booster.inplace_predict(X)
+
+
+class RecursiveForecaster:
+    """Forecast several days ahead with a model that uses the rolling trip features, feeding the predictions of each
+    day back into the features of the next days.
+
+    fit reads the history of each group (date_formatted, group column, is_weekend and trips). predict goes through the
+    future days in order: it computes the rolling features of all the groups of a day from the state, predicts them
+    with one model.predict call, and adds the predictions to the state. The state is copied, so predict can be called
+    again from the same history.
+
+    The model is any object with predict(DataFrame), like the XGBoost pipeline or an XGBoostArtifact. For the XGBoost
+    pipeline, the preprocessing runs once on future and each day only updates the rolling columns of the booster
+    inputs (see BoosterInputs), other models predict a DataFrame of the rows of each day.
+    """
+
+    def __init__(self, model, rolling=None, group_column='quadrant'):
+        self.model = model
+        self.rolling = rolling
+        self.group_column = group_column
+
+    def fit(self, history):
+        self.groups_ = pd.Index(history[self.group_column].unique())
+        self.state_ = RollingState(len(self.groups_), self.rolling or RollingAveragesTransformer())
+        trips = history['trips'].to_numpy(dtype='float64')
+        for groups, weekday, is_weekend, rows in self.days(history):
+            self.state_.push(groups, weekday, is_weekend, trips[rows])
+        return self
+
+    def days(self, X):
+        """Positions of the rows of each day of X in date order, with their group codes, weekday and is_weekend"""
+
+        dates = pd.to_datetime(X['date_formatted']).to_numpy()
+        groups = self.group_codes(X[self.group_column])
+        is_weekend = X['is_weekend'].to_numpy()
+
+        order = np.argsort(dates, kind='stable')
+        boundaries = np.flatnonzero(dates[order][1:] != dates[order][:-1]) + 1
+        for rows in np.split(order, boundaries):
+            weekday = pd.Timestamp(dates[rows[0]]).weekday()
+            yield groups[rows], weekday, int(is_weekend[rows[0]] == 1), rows
+
+    def group_codes(self, groups):
+        """Codes of the groups, new groups are added with an empty history"""
+
+        new = pd.Index(groups.unique()).difference(self.groups_)
+        if len(new):
+            self.groups_ = self.groups_.append(new)
+            self.state_.grow(len(self.groups_))
+        return self.groups_.get_indexer(groups)
+
+    def predict(self, future):
+        """Predict the rows of future, one day after the other. Returns future with the rolling features computed
+        from the history and the previous predictions, and a prediction column"""
+
+        # new groups are added before the state is copied
+        self.group_codes(future[self.group_column])
+        fitted_state = copy.deepcopy(self.state_)
+        inputs = BoosterInputs(self.model, future) if BoosterInputs.supports(self.model) else None
+        try:
+            features = {name: np.full(len(future), np.nan) for name in ROLLING_FEATURES}
+            prediction = np.full(len(future), np.nan)
+            for groups, weekday, is_weekend, rows in self.days(future):
+                day_features = self.state_.features(groups, weekday, is_weekend)
+                for name, values in day_features.items():
+                    features[name][rows] = values
+
+                # all the groups of the day in one batch
+                if inputs is not None:
+                    prediction[rows] = inputs.predict(rows, day_features)
+                else:
+                    prediction[rows] = self.model.predict(future.iloc[rows].assign(**day_features))
+                self.state_.push(groups, weekday, is_weekend, prediction[rows])
+        finally:
+            self.state_ = fitted_state
+
+        return future.assign(**features, prediction=prediction)
@@ -0,0 +1,173 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Methods of the pipeline steps that are traced
+TRACED_METHODS = ['fit', 'fit_transform', 'transform', 'predict']
+
+# Tracer used by instrument and trace, set with StageTracer.activate
+_active_tracer = None
+
+
+class StageTracer:
+    """Record each pipeline stage that runs while the tracer is active:
+    - wall_seconds and cpu_seconds (CPU time of the process, all threads)
+    - rows_in and rows_out
+    - memory_in_mb and memory_out_mb: size of the input and output data (deep=True also counts the strings)
+    - peak_rss_mb: peak resident memory of the process when the stage ended
+
+    Stages whose name starts with profile_stage are also run under cProfile, and the stats are saved in
+    profile_dir/<stage>.prof.
+    """
+
+    def __init__(self, profile_stage=None, profile_dir='.', deep=False):
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.deep = deep
+        self.stages = []
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._start = time.perf_counter()
+        self._running = set()
+
+    @contextmanager
+    def activate(self):
+        """Trace the stages run inside the block"""
+        global _active_tracer
+
+        previous, _active_tracer = _active_tracer, self
+        try:
+            yield self
+        finally:
+            _active_tracer = previous
+
+    def run(self, name, func, X, *args, **kwargs):
+        """Run func(X, *args, **kwargs) as the stage name and record it"""
+
+        memory_in = data_memory(X, self.deep)
+        profiler = cProfile.Profile() if self.profile_stage and name.startswith(self.profile_stage) else None
+
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            output = profiler.runcall(func, X, *args, **kwargs)
+        else:
+            output = func(X, *args, **kwargs)
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+        if profiler:
+            profiler.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+
+        self.stages.append({
+            'stage': name,
+            'start_seconds': start_wall - self._start,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'rows_in': data_rows(X),
+            'rows_out': data_rows(output),
+            'memory_in_mb': memory_in,
+            'memory_out_mb': data_memory(output, self.deep),
+            'peak_rss_mb': peak_rss_mb(),
+        })
+        return output
+
+    def traced_method(self, name, step, method):
+        """Method of a step that records each call, unless it is called from another traced method of the same step
+        (fit_transform calling fit and transform is recorded once)"""
+
+        original = getattr(step, method)
+
+        def traced(X, *args, **kwargs):
+            if id(step) in self._running:
+                return original(X, *args, **kwargs)
+            self._running.add(id(step))
+            try:
+                return self.run(f'{name}.{method}', original, X, *args, **kwargs)
+            finally:
+                self._running.discard(id(step))
+        return traced
+
+    def save(self, path):
+        """Save the trace as JSON"""
+
+        with open(path, 'w') as file:
+            json.dump({'started': self.started, 'stages': self.stages}, file, indent=2)
+        print(f'trace saved in {path}')
+
+    def summary(self):
+        """Stages as a dataframe"""
+        return pd.DataFrame(self.stages)
+
+
+@contextmanager
+def instrument(pipeline, prefix):
+    """Trace every step of the pipeline inside the block, named prefix.step.method. Does nothing if no tracer is active.
+
+    The traced methods are set on the step instances and removed when the block ends, so the pipeline can be pickled after.
+    """
+
+    tracer = _active_tracer
+    if tracer is None:
+        yield pipeline
+        return
+
+    patched = []
+    for name, step in pipeline.steps:
+        if step is None or step == 'passthrough':
+            continue
+        for method in TRACED_METHODS:
+            if hasattr(step, method) and method not in vars(step):
+                setattr(step, method, tracer.traced_method(f'{prefix}.{name}', step, method))
+                patched.append((step, method))
+    try:
+        yield pipeline
+    finally:
+        for step, method in patched:
+            delattr(step, method)
+
+
+def trace(name, func, X, *args, **kwargs):
+    """Run func(X, *args, **kwargs) as a stage of the active tracer, or just run it"""
+
+    if _active_tracer is None:
+        return func(X, *args, **kwargs)
+    return _active_tracer.run(name, func, X, *args, **kwargs)
+
+
+def data_rows(data):
+    if isinstance(data, (pd.DataFrame, pd.Series, np.ndarray)) or hasattr(data, 'tocsr'):
+        return data.shape[0]
+    return None
+
+
+def data_memory(data, deep=False):
+    """Size of dataframes, series, arrays and sparse matrices in MB"""
+
+    if isinstance(data, pd.DataFrame):
+        size = data.memory_usage(index=True, deep=deep).sum()
+    elif isinstance(data, pd.Series):
+        size = data.memory_usage(index=True, deep=deep)
+    elif isinstance(data, np.ndarray):
+        size = data.nbytes
+    elif hasattr(data, 'tocsr'):
+        data = data.tocsr()
+        size = data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    else:
+        return None
+    return size / 1024**2
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if os.uname().sysname == 'Darwin' else peak / 1024
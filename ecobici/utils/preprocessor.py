@@ -1,75 +1,177 @@
+"""Transformers of the preprocessing pipelines.
+
+Copy semantics: transformers add or replace columns of X in place and return X, so a pipeline keeps a single copy of
+the working set. Row order and the index are only changed in place (MergeHolidaysTransformer and
+ReplaceOutliersByDayOfWeek reset the index to a RangeIndex without copying the columns). The exception is
+AverageTempLast7DaysTransformer, which returns a sorted copy of the weather table (one row per day).
+Callers that need their input unchanged should pass X.copy().
+
+Dtypes are kept: with compact inputs (categorical quadrant, float32 weather) the outputs stay compact.
+"""
 from sklearn.base import BaseEstimator, TransformerMixin
 import pandas as pd
+import numpy as np
 
 class AddQuadrantColumn(BaseEstimator, TransformerMixin):
-    """Assign each origin station to a quadrant based on latitude and longitude"""
+    """Assign each origin station to a quadrant based on latitude and longitude.
+
+    - mode='quadrant': split the city in 4 quadrants (NE, NO, SE, SO) at lat_split and long_split
+    - mode='comunas': assign the comuna polygon that contains the station, read from comunas_path.
+      The polygons are indexed once in fit, and each unique station is located only once. Stations outside every
+      polygon (e.g. on the coast or the city limits) are assigned to the nearest comuna within max_comuna_distance
+      meters, the ones further away are left without comuna and their trips are not counted. Both are reported.
+    - mode='station': keep each origin station as its own group, to forecast by station
+
+    The group is always stored in the quadrant column, so the next steps work the same for every mode.
+    With categorical=True the column is categorical instead of strings.
+    """
+    def __init__(self, lat_split=-34.6, long_split=-58.43, mode='quadrant', comunas_path='comunas/comunas_wgs84.shp',
+                 lat_column='lat_estacion_origen', long_column='long_estacion_origen', station_column='id_estacion_origen',
+                 categorical=False, max_comuna_distance=1000):
+        self.lat_split = lat_split
+        self.long_split = long_split
+        self.mode = mode
+        self.comunas_path = comunas_path
+        self.lat_column = lat_column
+        self.long_column = long_column
+        self.station_column = station_column
+        self.categorical = categorical
+        self.max_comuna_distance = max_comuna_distance
+
     def fit(self, X, y=None):
+        if self.mode == 'comunas':
+            import geopandas as gpd
+
+            comunas = gpd.read_file(self.comunas_path).to_crs('EPSG:4326')
+            self.comunas_ = comunas[['COMUNAS', 'geometry']].reset_index(drop=True)
+            # build the spatial indexes once, they are reused on every transform. Distances to the nearest comuna are
+            # measured in the UTM zone of the city
+            self.comunas_.sindex
+            self.comunas_projected_ = self.comunas_.to_crs(self.comunas_.estimate_utm_crs())
+            self.comunas_projected_.sindex
+        elif self.mode not in ('quadrant', 'station'):
+            raise ValueError(f"mode must be 'quadrant', 'comunas' or 'station', got {self.mode!r}")
         return self
 
     def transform(self, X):
-        X['quadrant'] = X.apply(self.determine_quadrant, axis=1)
+        if self.mode == 'comunas':
+            quadrant = self.determine_comuna(X[self.lat_column], X[self.long_column])
+        elif self.mode == 'station':
+            quadrant = X[self.station_column]
+        else:
+            quadrant = self.determine_quadrant(X[self.lat_column].to_numpy(), X[self.long_column].to_numpy())
+
+        X['quadrant'] = pd.Categorical(quadrant) if self.categorical else quadrant
         return X
 
-    def determine_quadrant(self, row):
-        if row['lat_estacion_origen'] > -34.6:
-            if row['long_estacion_origen'] > -58.43:
-                return 'NE'
-            else:
-                return 'NO'
-        else:
-            if row['long_estacion_origen'] > -58.43:
-                return 'SE'
-            else:
-                return 'SO'
+    def determine_quadrant(self, lat, long):
+        north = lat > self.lat_split
+        east = long > self.long_split
+        if self.categorical:
+            # codes of NE, NO, SE, SO
+            return pd.Categorical.from_codes(2 * ~north + ~east, categories=['NE', 'NO', 'SE', 'SO'])
+        return np.where(north, np.where(east, 'NE', 'NO'), np.where(east, 'SE', 'SO')).astype(object)
+
+    def determine_comuna(self, lat, long):
+        import geopandas as gpd
+
+        if not hasattr(self, 'comunas_'):
+            self.fit(None)
+
+        # locate each unique station once and broadcast the result back to the trips
+        coords = pd.DataFrame({'lat': lat.to_numpy(), 'long': long.to_numpy()})
+        station_codes, stations = pd.MultiIndex.from_frame(coords).factorize()
+        points = gpd.points_from_xy(stations.get_level_values(1), stations.get_level_values(0), crs='EPSG:4326')
+        point_idx, comuna_idx = self.comunas_.sindex.query(points, predicate='within')
+
+        labels = np.array([f'C{int(c):02d}' for c in self.comunas_['COMUNAS']])
+        station_comuna = np.full(len(stations), None, dtype=object)
+        station_comuna[point_idx] = labels[comuna_idx]
+
+        # stations outside every polygon take the nearest comuna within max_comuna_distance
+        outside = np.flatnonzero(pd.isna(station_comuna))
+        if len(outside):
+            projected = gpd.GeoSeries(points[outside]).to_crs(self.comunas_projected_.crs)
+            (near_idx, comuna_idx), _ = self.comunas_projected_.sindex.nearest(
+                projected, return_all=False, max_distance=self.max_comuna_distance, return_distance=True)
+            station_comuna[outside[near_idx]] = labels[comuna_idx]
+            print(f'{len(near_idx)} stations outside the comunas assigned to the nearest comuna')
+
+        comuna = np.where(station_codes >= 0, station_comuna[station_codes], None)
+        unlocated = pd.isna(station_comuna)
+        if unlocated.any():
+            print(f'{unlocated.sum()} stations more than {self.max_comuna_distance} m from every comuna are left without comuna, '
+                  f'{pd.isna(comuna).sum()} rows are not counted')
+        return comuna
 
 class DatetimeTransformer(TransformerMixin):
-    """Transform origin date to datetime"""
+    """Transform origin date to datetime.
+
+    The timestamps are parsed with a fixed format, which is much faster than inferring it for each value.
+    With format=None the format is inferred.
+    """
+    def __init__(self, format='%Y-%m-%d %H:%M:%S'):
+        self.format = format
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        X['fecha_origen_recorrido'] = pd.to_datetime(X['fecha_origen_recorrido'])
+        X['fecha_origen_recorrido'] = pd.to_datetime(X['fecha_origen_recorrido'], format=self.format)
         return X
 
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
 class DateFeaturesTransformer(TransformerMixin):
     """Extract date features:
-    - date_formatted: date formatted as '%Y-%m-%d'
-    - month: month as '%Y-%m'
+    - date_formatted: date formatted as '%Y-%m-%d', categorical
+    - month: month as '%Y-%m', categorical
     - weekday: day of the week ordered as 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'
-    - is_weekend: flag for Saturday and Sunday
+    - is_weekend: flag for Saturday and Sunday, int8
+
+    The features are computed once per unique day and broadcast to the rows with the day codes,
+    so no string is created per row.
     """
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        X['date_formatted'] = X['fecha_origen_recorrido'].dt.strftime('%Y-%m-%d')
-        X['month'] = X['fecha_origen_recorrido'].dt.strftime('%Y-%m')
-        X['weekday'] = X['fecha_origen_recorrido'].dt.day_name()
-        weekday_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        X['weekday'] = pd.Categorical(X['weekday'], categories=weekday_order, ordered=True)
-        X['is_weekend'] = (X['weekday'].isin(['Saturday', 'Sunday'])).astype(int)
+        days = X['fecha_origen_recorrido'].to_numpy().astype('datetime64[D]')
+        codes, unique_days = pd.factorize(days)
+        unique_days = pd.DatetimeIndex(unique_days)
+
+        X['date_formatted'] = pd.Categorical.from_codes(codes, categories=unique_days.strftime('%Y-%m-%d'))
+        months, month_codes = np.unique(unique_days.strftime('%Y-%m'), return_inverse=True)
+        X['month'] = pd.Categorical.from_codes(np.where(codes >= 0, month_codes[codes], -1), categories=months)
+
+        # rows without date keep a missing weekday and is_weekend=0
+        weekday = np.where(codes >= 0, unique_days.dayofweek.to_numpy()[codes], -1)
+        X['weekday'] = pd.Categorical.from_codes(weekday, categories=WEEKDAYS, ordered=True)
+        X['is_weekend'] = (weekday >= 5).astype('int8')
         return X
 
 class TimeFeaturesTransformer(TransformerMixin):
     """Extract time features:
-    - hour: Hour of the trip
-    - time_segment: segmetn hours into 'Morning', 'Noon', 'Afternoon', 'Night'
+    - hour: Hour of the trip, int8
+    - time_segment: segment hours into 'Morning', 'Noon', 'Afternoon', 'Night', categorical
     """
 
+    # segment of each hour of the day: Night before 5, Morning before 12, Noon before 17, Afternoon before 21, then Night
+    TIME_SEGMENTS = ['Night', 'Morning', 'Noon', 'Afternoon']
+    HOUR_SEGMENTS = np.array([0] * 5 + [1] * 7 + [2] * 5 + [3] * 4 + [0] * 3)
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        X['hour'] = X['fecha_origen_recorrido'].dt.hour
-        conditions = [
-            (X['hour'] >= 5) & (X['hour'] < 12),
-            (X['hour'] >= 12) & (X['hour'] < 17),
-            (X['hour'] >= 17) & (X['hour'] < 21),
-            (X['hour'] >= 21) | (X['hour'] < 5)
-        ]
-        time_segments = ['Night', 'Morning', 'Noon', 'Afternoon', 'Night']
-        X['time_segment'] = pd.cut(X['hour'], bins=[0, 5, 12, 17, 21, 24], labels=time_segments, right=False, ordered=False)
+        hour = X['fecha_origen_recorrido'].dt.hour
+        X['hour'] = hour.astype('float32' if hour.isna().any() else 'int8')
+
+        codes = np.full(len(X), -1)
+        known = hour.notna().to_numpy()
+        codes[known] = self.HOUR_SEGMENTS[hour.to_numpy()[known].astype(int)]
+        X['time_segment'] = pd.Categorical.from_codes(codes, categories=self.TIME_SEGMENTS)
         return X
 
 
@@ -101,61 +203,138 @@ class RatioTempTransformer(BaseEstimator, TransformerMixin):
 class RollingAveragesTransformer(BaseEstimator, TransformerMixin):
     """Calculate rolling average features for trips - separated by weekdays and weekends:
         - trips_last_day
-        - avg_trips_last_week
-        - avg_trips_last_month
-        - trips_same_day_last_week
+        - avg_trips_last_week: mean of the last week_window days (5 weekdays or 2 weekend days)
+        - avg_trips_last_month: mean of the last month_window days (20 weekdays or 8 weekend days)
+        - trips_same_day_last_week: trips same_day_lag rows back in the series of the same weekday
 
     Rollings are calculated over the weekday series or the weekend series, but not combined.
-    
+    Each series is keyed by (group_column, is_weekend) and follows the row order of X, which is expected to be sorted by date.
+    Windows and lags count rows, so X needs one row per day and group for them to span calendar days: the days without
+    trips of a group are added with 0 trips when the trips are counted (see preprocessing.complete_periods).
+    All the series are computed at once with cumulative sums over the rows sorted by series, so the cost does not
+    depend on the number of groups.
     """
+    def __init__(self, group_column='quadrant', weekday_week_window=5, weekday_month_window=20, weekday_same_day_lag=5,
+                 weekend_week_window=2, weekend_month_window=8, weekend_same_day_lag=2):
+        self.group_column = group_column
+        self.weekday_week_window = weekday_week_window
+        self.weekday_month_window = weekday_month_window
+        self.weekday_same_day_lag = weekday_same_day_lag
+        self.weekend_week_window = weekend_week_window
+        self.weekend_month_window = weekend_month_window
+        self.weekend_same_day_lag = weekend_same_day_lag
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
+        trips = X['trips'].to_numpy(dtype='float64')
+        is_weekend = X['is_weekend'].to_numpy() == 1
+        series = X.groupby([self.group_column, 'is_weekend'], sort=False, observed=True).ngroup().to_numpy()
+        weekday = X['date'].dt.weekday.to_numpy()
 
-        # Partition by quadrant
-        for quadrant in X['quadrant'].unique():
-            quadrant_mask = X['quadrant'] == quadrant
-            weekday_mask = X['is_weekend'] == 0
-
-            mask = quadrant_mask & weekday_mask
-
-            # 1. Trips Last Day
-            X.loc[mask, 'trips_last_day'] = X.loc[mask, 'trips'].shift(1)
-
-            # 2. Average Trips Last Week - Las 5 weekday days
-            X.loc[mask, 'avg_trips_last_week'] = X.loc[mask, 'trips'].shift().rolling(window=5, min_periods=1).mean()
+        week_window = np.where(is_weekend, self.weekend_week_window, self.weekday_week_window)
+        month_window = np.where(is_weekend, self.weekend_month_window, self.weekday_month_window)
+        same_day_lag = np.where(is_weekend, self.weekend_same_day_lag, self.weekday_same_day_lag)
 
-            # 3. Average Trips Last Month - Last 20 weekday days (no weekends)
-            X.loc[mask, 'avg_trips_last_month'] = X.loc[mask, 'trips'].shift().rolling(window=20, min_periods=1).mean()
+        # rows without group are left without features
+        missing = series < 0
 
-            # 4. Trips Same Day Last Week - 5 days ago
-            X.loc[mask, 'trips_same_day_last_week'] = X.loc[mask].groupby(X['date'].dt.weekday)['trips'].shift(5)
+        # 1. Trips Last Day
+        X['trips_last_day'] = self.lag(trips, series, np.ones(len(X), dtype=int), missing)
 
-        # Calculate rolling averages for weekends - only usings weekend days
+        # 2. Average Trips Last Week
+        X['avg_trips_last_week'] = self.rolling_mean(trips, series, week_window, missing)
 
-        # Partition by quadrant
-        for quadrant in X['quadrant'].unique():
-            quadrant_mask = X['quadrant'] == quadrant
-            weekday_mask = X['is_weekend'] == 1
+        # 3. Average Trips Last Month
+        X['avg_trips_last_month'] = self.rolling_mean(trips, series, month_window, missing)
 
-            mask = quadrant_mask & weekday_mask
+        # 4. Trips Same Day Last Week - same weekday, same_day_lag rows back
+        X['trips_same_day_last_week'] = self.lag(trips, series * 7 + weekday, same_day_lag, missing)
 
-            # 1. Trips Last Day
-            X.loc[mask, 'trips_last_day'] = X.loc[mask, 'trips'].shift(1)
-
-            # 2. Average Trips Last Week - Last 2 weekend days
-            X.loc[mask, 'avg_trips_last_week'] = X.loc[mask, 'trips'].shift().rolling(window=2, min_periods=1).mean()
-
-            # 3. Average Trips Last Month - Last 8 weekend days
-            X.loc[mask, 'avg_trips_last_month'] = X.loc[mask, 'trips'].shift().rolling(window=8, min_periods=1).mean()
+        return X
 
-            # 4. Trips Same Day Last Week
-            X.loc[mask, 'trips_same_day_last_week'] = X.loc[mask].groupby(X['date'].dt.weekday)['trips'].shift(2)
+    @staticmethod
+    def group_positions(groups):
+        """Return the order that sorts rows by group keeping the row order inside each group,
+        and the index where each sorted row's group starts"""
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        is_start = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+        group_start = np.maximum.accumulate(np.where(is_start, np.arange(len(groups)), 0))
+        return order, group_start
+
+    def lag(self, values, groups, lag, missing):
+        """Value lag rows back in the same group, NaN when the group has fewer previous rows"""
+        order, group_start = self.group_positions(groups)
+        lag = lag[order]
+        source = np.arange(len(values)) - lag
+
+        lagged = np.full(len(values), np.nan)
+        valid = source >= group_start
+        lagged[valid] = values[order][source[valid]]
+
+        result = np.empty(len(values))
+        result[order] = lagged
+        result[missing] = np.nan
+        return result
+
+    def rolling_mean(self, values, groups, window, missing):
+        """Mean of the previous window rows in the same group (ignoring NaN), NaN when there are no previous rows"""
+        order, group_start = self.group_positions(groups)
+        sorted_values = values[order]
+        window = window[order]
+
+        valid = ~np.isnan(sorted_values)
+        cum_sum = np.r_[0, np.cumsum(np.where(valid, sorted_values, 0))]
+        cum_count = np.r_[0, np.cumsum(valid)]
+
+        end = np.arange(len(values))
+        start = np.maximum(end - window, group_start)
+        total = cum_sum[end] - cum_sum[start]
+        count = cum_count[end] - cum_count[start]
+
+        mean = np.full(len(values), np.nan)
+        np.divide(total, count, out=mean, where=count > 0)
+
+        result = np.empty(len(values))
+        result[order] = mean
+        result[missing] = np.nan
+        return result
+    
+class HourlyRollingAveragesTransformer(RollingAveragesTransformer):
+    """Calculate hour-aware rolling features for trips by hour:
+        - trips_last_hour
+        - avg_trips_last_day: mean of the last day_window hours
+        - trips_same_hour_yesterday
+        - trips_same_hour_last_week: trips at the same hour same_hour_days days back
+        - avg_trips_same_hour_last_week: mean of the same hour over the last same_hour_days days
+
+    Each series is keyed by group_column and follows the row order of X, which is expected to be sorted by date and hour
+    with every hour present (hours without trips as 0), so that lags in rows are lags in hours.
+    """
+    def __init__(self, group_column='quadrant', hour_column='hour', day_window=24, same_hour_days=7):
+        self.group_column = group_column
+        self.hour_column = hour_column
+        self.day_window = day_window
+        self.same_hour_days = same_hour_days
 
+    def transform(self, X):
+        trips = X['trips'].to_numpy(dtype='float64')
+        series = X.groupby(self.group_column, sort=False, observed=True).ngroup().to_numpy()
+        same_hour_series = series * 24 + X[self.hour_column].to_numpy().astype(int)
+        ones = np.ones(len(X), dtype=int)
+
+        # rows without group are left without features
+        missing = series < 0
+
+        X['trips_last_hour'] = self.lag(trips, series, ones, missing)
+        X['avg_trips_last_day'] = self.rolling_mean(trips, series, np.full(len(X), self.day_window), missing)
+        X['trips_same_hour_yesterday'] = self.lag(trips, same_hour_series, ones, missing)
+        X['trips_same_hour_last_week'] = self.lag(trips, same_hour_series, np.full(len(X), self.same_hour_days), missing)
+        X['avg_trips_same_hour_last_week'] = self.rolling_mean(trips, same_hour_series, np.full(len(X), self.same_hour_days), missing)
+        return X
 
-            return X
-    
 # Custom transformer for merging holidays and adding 'is_holiday' column
 class MergeHolidaysTransformer(BaseEstimator, TransformerMixin):
     """Add flag for holidays"""
@@ -167,38 +346,72 @@ class MergeHolidaysTransformer(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X):
-        merged_df = X.merge(self.holidays_df, left_on='date_formatted', right_on='Date', how='left')
-        merged_df['is_holiday'] = merged_df['Holiday'].notnull().astype('int')
-        return merged_df
+        # Look up each date in the holidays table instead of merging, so the rows are not copied
+        holidays = self.holidays_df.drop_duplicates('Date').set_index('Date')['Holiday']
+        holiday = X['date_formatted'].map(holidays)
+
+        X.index = pd.RangeIndex(len(X))
+        X['Date'] = X['date_formatted'].where(holiday.notnull().to_numpy())
+        X['Holiday'] = holiday.to_numpy()
+        X['is_holiday'] = X['Holiday'].notnull().astype('int8')
+        return X
     
 
 class ReplaceOutliersByDayOfWeek(BaseEstimator, TransformerMixin):
-    """Identify outliers using the inter-quertile range method grouping by quadrant and weekday. Replace outliers with the mean for the group."""
-    def __init__(self, iqr_multiplier=1.5, outlier_flag_column='is_outlier'):
+    """Identify outliers using the inter-quertile range method grouping by quadrant and weekday. Replace outliers with the
+    mean of the values of the group that are not outliers.
+    group_columns sets the groups, e.g. ('weekday', 'hour', 'quadrant') for trips by hour.
+
+    fit learns a table indexed by group_columns with the bounds of each group and the value that replaces its
+    outliers (the mean of the values inside the bounds in fit). Fit it on the training days only, so the bounds and
+    replacements do not use the days that are evaluated. transform only looks up
+    the group of each row in that table, so a fitted object can score new days without the history, and rows of
+    groups not seen in fit are left unchanged.
+    """
+    def __init__(self, iqr_multiplier=1.5, outlier_flag_column='is_outlier', group_columns=('weekday', 'quadrant')):
         self.iqr_multiplier = iqr_multiplier
         self.outlier_flag_column = outlier_flag_column
+        self.group_columns = group_columns
 
     def fit(self, X, y=None):
-        return self
-
-    def transform(self, X):
         # Group by day of the week and calculate IQR for each group
-        grouped = X.groupby(['weekday','quadrant'])['trips']
+        grouped = X.groupby(list(self.group_columns), observed=True)['trips']
         q1 = grouped.quantile(0.25)
         q3 = grouped.quantile(0.75)
         iqr = q3 - q1
 
         # Define the lower and upper bounds to flag outliers
-        lower_bound = (q1 - self.iqr_multiplier * iqr).reset_index().rename(columns={'trips':'lower'})
-        upper_bound = (q3 + self.iqr_multiplier * iqr).reset_index().rename(columns={'trips':'upper'})
+        bounds = pd.DataFrame({'lower': q1 - self.iqr_multiplier * iqr, 'upper': q3 + self.iqr_multiplier * iqr})
 
-        # Flag outliers
-        X = X.merge(lower_bound, on=['weekday','quadrant'], how='left').merge(upper_bound, on=['weekday','quadrant'], how='left')
-        X[self.outlier_flag_column] = (X['trips'] > X['upper']) | (X['trips'] < X['lower'])
-        X = X.drop(columns=['lower','upper'])
+        # Mean of the values of each group that are not outliers
+        codes = self.group_codes(X, bounds.index)
+        inliers = ~self.flag_outliers(X['trips'].to_numpy(), codes, bounds)
+        keys = [X[column].to_numpy()[inliers] for column in self.group_columns]
+        inlier_mean = X['trips'][inliers].groupby(keys).mean()
+        bounds['replacement'] = inlier_mean.reindex(bounds.index).fillna(grouped.mean())
+
+        self.bounds_ = bounds
+        return self
 
-        # Impute outliers with the mean for quadrant and day of week
-        X.loc[X['is_outlier'], 'trips'] = X[X['is_outlier']].groupby(['quadrant', 'weekday'])['trips'].transform('mean')
+    def transform(self, X):
+        codes = self.group_codes(X, self.bounds_.index)
 
+        # Flag outliers
+        X.index = pd.RangeIndex(len(X))
+        X[self.outlier_flag_column] = self.flag_outliers(X['trips'].to_numpy(), codes, self.bounds_)
 
+        # Impute outliers with the mean of the non outliers for quadrant and day of week
+        outliers = X[self.outlier_flag_column].to_numpy()
+        X.loc[outliers, 'trips'] = self.bounds_['replacement'].to_numpy()[codes[outliers]]
         return X
+
+    def group_codes(self, X, index):
+        """Row of the bounds table for each row of X, -1 for groups not in the table"""
+        return index.get_indexer(pd.MultiIndex.from_arrays([X[column] for column in self.group_columns]))
+
+    @staticmethod
+    def flag_outliers(trips, codes, bounds):
+        # code -1 picks the NaN appended at the end, which is never an outlier
+        lower = np.append(bounds['lower'].to_numpy(), np.nan)[codes]
+        upper = np.append(bounds['upper'].to_numpy(), np.nan)[codes]
+        return (trips > upper) | (trips < lower)
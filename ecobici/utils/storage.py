@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columns that repeat the date already stored in date_formatted
+DUPLICATE_DATE_COLUMNS = ['Date', 'time', 'time_formatted', 'date']
+
+
+def write_dataset(df, path, partition_cols=('month',), append=False):
+    """Write the preprocessed dataset as a Parquet dataset partitioned by month.
+
+    Column types are kept (weekday stays an ordered categorical, flags stay integers or booleans),
+    and the duplicated date columns are dropped. An existing dataset in path is replaced, unless append=True,
+    in which case the rows are written as new files in their month partitions.
+    """
+    df = df.drop(columns=[c for c in DUPLICATE_DATE_COLUMNS if c in df.columns]).reset_index(drop=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    if os.path.exists(path) and not append:
+        shutil.rmtree(path)
+    pq.write_to_dataset(table, path, partition_cols=list(partition_cols))
+
+
+def read_dataset(path, columns=None, filters=None, memory_map=True):
+    """Read a Parquet dataset written by write_dataset.
+
+    - columns: read only these columns
+    - filters: pyarrow filters to skip partitions, e.g. [('month', '>=', '2022-11')]
+    - memory_map: memory map the files instead of reading them into buffers
+    """
+    table = pq.read_table(path, columns=columns, filters=filters, memory_map=memory_map)
+    df = table.to_pandas()
+
+    # the month partition is read back as a categorical, keep it as the '%Y-%m' string
+    if 'month' in df.columns:
+        df['month'] = df['month'].astype(str)
+    return df
+
+
+def dataset_columns(path):
+    """Column names of a Parquet dataset, including the partition columns"""
+    return pq.ParquetDataset(path).schema.names
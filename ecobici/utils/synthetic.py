@@ -0,0 +1,115 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Row counts used by the benchmarks
+SIZES = {'100k': 100_000, '1M': 1_000_000, '10M': 10_000_000, '50M': 50_000_000}
+
+# Area covered by the stations
+LAT_RANGE = (-34.69, -34.54)
+LONG_RANGE = (-58.53, -58.35)
+
+# Relative number of trips by hour of the day and by day of the week (Monday first)
+HOUR_WEIGHTS = np.array([2, 1, 1, 1, 1, 2, 4, 8, 11, 9, 7, 7, 8, 8, 8, 9, 11, 13, 11, 8, 6, 5, 4, 3], dtype=float)
+WEEKDAY_WEIGHTS = np.array([1.0, 1.05, 1.05, 1.05, 1.0, 0.6, 0.5])
+
+
+def make_stations(n_stations=300, seed=0):
+    """Stations with an id, name, address and coordinates inside the city"""
+
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(1, n_stations + 1)
+    return pd.DataFrame({
+        'id': [f'{i}BAEcobici' for i in numbers],
+        'name': [f'{i:03d} - Estacion {i}' for i in numbers],
+        'address': [f'Calle {i} {100 * i}' for i in numbers],
+        'long': rng.uniform(*LONG_RANGE, n_stations).round(6),
+        'lat': rng.uniform(*LAT_RANGE, n_stations).round(6),
+        # some stations are much busier than others
+        'weight': rng.lognormal(0, 0.7, n_stations),
+    })
+
+
+def generate_trips(n_rows, stations, start='2022-01-01', days=365, seed=0, first_id=0):
+    """Generate n_rows trips with the schema of the trips dataset.
+
+    Trips follow daily and weekly patterns by hour and weekday, and busier stations get more trips.
+    Timestamps are strings formatted as '%Y-%m-%d %H:%M:%S', like in the original file.
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=days, freq='D')
+
+    day_weights = WEEKDAY_WEIGHTS[dates.dayofweek]
+    day = rng.choice(days, n_rows, p=day_weights / day_weights.sum())
+    hour = rng.choice(24, n_rows, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    origin_seconds = hour * 3600 + rng.integers(0, 3600, n_rows)
+    duration = rng.gamma(2, 700, n_rows).astype(int) + 60
+
+    station_weights = stations['weight'].to_numpy() / stations['weight'].sum()
+    origin = rng.choice(len(stations), n_rows, p=station_weights)
+    destination = rng.choice(len(stations), n_rows, p=station_weights)
+
+    # timestamps are built from the strings of each day and each second of the day, not formatted per row
+    extra_days = (origin_seconds + duration) // 86400
+    destination_seconds = (origin_seconds + duration) % 86400
+    all_days = pd.date_range(start, periods=days + 1 + duration.max(initial=0) // 86400, freq='D')
+    day_strings = np.asarray(all_days.strftime('%Y-%m-%d '), dtype=object)
+    second_strings = np.asarray([f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in range(86400)], dtype=object)
+
+    ids = np.arange(first_id, first_id + n_rows)
+    return pd.DataFrame({
+        'Id_recorrido': [f'{i}BAEcobici' for i in ids],
+        'duracion_recorrido': [f'{d:,}' for d in duration],
+        'fecha_origen_recorrido': day_strings[day] + second_strings[origin_seconds],
+        'id_estacion_origen': stations['id'].to_numpy()[origin],
+        'nombre_estacion_origen': stations['name'].to_numpy()[origin],
+        'direccion_estacion_origen': stations['address'].to_numpy()[origin],
+        'long_estacion_origen': stations['long'].to_numpy()[origin],
+        'lat_estacion_origen': stations['lat'].to_numpy()[origin],
+        'fecha_destino_recorrido': day_strings[day + extra_days] + second_strings[destination_seconds],
+        'id_estacion_destino': stations['id'].to_numpy()[destination],
+        'nombre_estacion_destino': stations['name'].to_numpy()[destination],
+        'direccion_estacion_destino': stations['address'].to_numpy()[destination],
+        'long_estacion_destino': stations['long'].to_numpy()[destination],
+        'lat_estacion_destino': stations['lat'].to_numpy()[destination],
+        'id_usuario': [f'{u}BAEcobici' for u in rng.integers(1, max(n_rows // 20, 2), n_rows)],
+        'modelo_bicicleta': rng.choice(['ICONIC', 'FIT'], n_rows, p=[0.8, 0.2]),
+        'Género': rng.choice(['FEMALE', 'MALE', 'OTHER'], n_rows, p=[0.4, 0.55, 0.05]),
+    })
+
+
+def write_trips(path, n_rows, chunksize=1_000_000, n_stations=300, seed=0):
+    """Write a synthetic trips file of n_rows in chunks, so large files are generated with bounded memory.
+
+    Like the original file, it starts with two index columns that load_trips drops.
+    """
+
+    stations = make_stations(n_stations, seed=seed)
+    for i, first_row in enumerate(range(0, n_rows, chunksize)):
+        rows = min(chunksize, n_rows - first_row)
+        chunk = generate_trips(rows, stations, seed=seed + i + 1, first_id=first_row)
+        chunk.insert(0, 'X', np.arange(first_row + 1, first_row + rows + 1))
+        chunk.index = range(first_row, first_row + rows)
+        chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0)
+        print(f'written {first_row + rows} rows')
+
+
+def parse_size(size):
+    """Row count from a name in SIZES ('1M') or a number"""
+    return SIZES[size] if size in SIZES else int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic trips file with the schema of the trips dataset')
+    parser.add_argument('--rows', default='1M', help=f'number of trips, one of {", ".join(SIZES)} or a number')
+    parser.add_argument('--output', default='data/trips_synthetic.csv')
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_trips(args.output, parse_size(args.rows), n_stations=args.stations, seed=args.seed)
+
+if __name__ == "__main__":
+    main()